@@ -1,23 +1,28 @@
 import math
 import random
-import functools
+import heapq
 import numpy as np
-from utility import alphabetize, abs_mean
+from utility import abs_mean
 
+import csv
+import json
 import time
 import numpy as np
-import matplotlib.pylab as plt
-import matplotlib
+import threading
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 
 
 class ValuedElement(object):
     """
     This is an abstract class that all Network elements inherit from
+    Subclasses declare the slot(s) their value is stored in.
     """
+    __slots__ = ('my_name',)
+
     def __init__(self,name,val):
         self.my_name = name
-        self.my_value = val
+        self.set_value(val)
 
     def set_value(self,val):
         self.my_value = val
@@ -29,13 +34,15 @@ class ValuedElement(object):
         return self.my_name
 
     def __repr__(self):
-        return "%s(%1.2f)" %(self.my_name, self.my_value)
+        return "%s(%1.2f)" %(self.my_name, self.get_value())
 
 class DifferentiableElement(object):
     """
     This is an abstract interface class implemented by all Network
     parts that require some differentiable element.
     """
+    __slots__ = ()
+
     def output(self):
         raise NotImplementedError("This is an abstract method")
 
@@ -57,6 +64,8 @@ class Input(ValuedElement,DifferentiableElement):
     These may represent variable inputs as well as fixed inputs
     (Thresholds) that are always set to -1.
     """
+    __slots__ = ('my_value',)
+
     def __init__(self,name,val):
         ValuedElement.__init__(self,name,val)
         DifferentiableElement.__init__(self)
@@ -78,16 +87,54 @@ class Input(ValuedElement,DifferentiableElement):
 class Weight(ValuedElement):
     """
     Representation of an weight into a Neural Unit.
+    Once the weight joins a Network its value and next value are a
+    view into column [my_index] of the network's (2, n) float64 buffer;
+    before that they are kept in the weight itself.
     """
+    __slots__ = ('my_value', 'my_next_value', 'my_buffer', 'my_index', 'my_id')
+
     def __init__(self,name,val):
+        self.my_buffer = None
+        self.my_index = None
+        self.my_next_value = None
+        self.my_id = None # index into network.weights, see index_connectivity
         ValuedElement.__init__(self,name,val)
-        self.next_value = None
+
+    def set_value(self,val):
+        if self.my_buffer is None:
+            self.my_value = val
+        else:
+            self.my_buffer[0, self.my_index] = val
+
+    def get_value(self):
+        if self.my_buffer is None:
+            return self.my_value
+        return float(self.my_buffer[0, self.my_index])
 
     def set_next_value(self,val):
-        self.next_value = val
+        if self.my_buffer is None:
+            self.my_next_value = val
+        else:
+            self.my_buffer[1, self.my_index] = val
 
     def update(self):
-        self.my_value = self.next_value
+        if self.my_buffer is None:
+            self.my_value = self.my_next_value
+        else:
+            self.my_buffer[0, self.my_index] = self.my_buffer[1, self.my_index]
+
+    def bind(self, buffer, index):
+        """Moves this weight's storage to column [index] of [buffer]."""
+        value = self.get_value()
+        if self.my_buffer is None:
+            next_value = self.my_next_value
+            del self.my_value, self.my_next_value
+        else:
+            next_value = self.my_buffer[1, self.my_index]
+        buffer[0, index] = value
+        buffer[1, index] = np.nan if next_value is None else next_value
+        self.my_buffer = buffer
+        self.my_index = index
 
 
 
@@ -98,6 +145,11 @@ class Neuron(DifferentiableElement):
     """
     Representation of a single sigmoid Neural Unit.
     """
+    __slots__ = ('my_name', 'my_inputs', 'my_weights', 'use_cache',
+                 'my_clock', 'my_output', 'my_output_epoch', 'my_doutdx',
+                 'my_doutdx_epoch', 'my_descendant_weights',
+                 'my_direct_weights', 'my_id', 'my_weight_reach')
+
     def __init__(self, name, inputs, input_weights, use_cache=True):
         assert len(inputs)==len(input_weights)
         for i in range(len(inputs)):
@@ -108,9 +160,14 @@ class Neuron(DifferentiableElement):
         self.my_inputs = inputs # list of Neuron or Input instances
         self.my_weights = input_weights # list of Weight instances
         self.use_cache = use_cache
+        self.my_clock = [0] # shared with the Network, see Network.clear_cache
+        self.my_output = None
+        self.my_doutdx = {}
         self.clear_cache()
         self.my_descendant_weights = None
         self.my_direct_weights = None
+        self.my_id = None
+        self.my_weight_reach = None
 
     def get_descendant_weights(self):
         """
@@ -140,37 +197,54 @@ class Neuron(DifferentiableElement):
 
         return self.my_descendant_weights
 
+    def get_weight_reach(self):
+        """
+        Returns a mapping of the ids of direct weights into this neuron
+        to a bitset (an int, bit k set for weight id k) of all the
+        weights feeding the input behind that direct weight.
+        """
+        if self.my_weight_reach is None:
+            # not part of a Network yet, index the subgraph feeding it
+            neurons = upstream_neurons(self)
+            weights = []
+            for n in neurons:
+                weights += n.get_weights()
+            index_connectivity(neurons, weights)
+        return self.my_weight_reach
+
     def isa_descendant_weight_of(self, target, weight):
         """
         Checks if [target] is a indirect input weight into this Neuron
         via the direct input weight [weight].
         """
-        weights = self.get_descendant_weights()
-        if weight.get_name() in weights:
-            return target.get_name() in weights[weight.get_name()]
-        else:
+        reach = self.get_weight_reach().get(weight.my_id)
+        if reach is None:
             raise Exception("weight %s is not connect to this node: %s"
                             %(weight, self))
+        return target.my_id is not None and (reach >> target.my_id) & 1 == 1
 
     def has_weight(self, weight):
         """
         Checks if [weight] is a direct input weight into this Neuron.
         """
-        return weight.get_name() in self.get_descendant_weights()
+        reach = self.get_weight_reach()
+        return weight.my_id is not None and weight.my_id in reach
 
     def get_weight_nodes(self):
         return self.my_weights
 
     def clear_cache(self):
-        self.my_output = None
-        self.my_doutdx = {}
+        # cached values are only valid while their epoch matches my_clock
+        self.my_output_epoch = None
+        self.my_doutdx_epoch = None
 
     def output(self):
         # Implement compute_output instead!!
         if self.use_cache:
             # caching optimization, saves previously computed output.
-            if self.my_output is None:
+            if self.my_output_epoch != self.my_clock[0]:
                 self.my_output = self.compute_output()
+                self.my_output_epoch = self.my_clock[0]
             return self.my_output
         return self.compute_output()
 
@@ -185,31 +259,31 @@ class Neuron(DifferentiableElement):
 
     def dOutdX(self, elem):
         if self.use_cache:
+            if self.my_doutdx_epoch != self.my_clock[0]:
+                self.my_doutdx.clear()
+                self.my_doutdx_epoch = self.my_clock[0]
             if elem not in self.my_doutdx:
                 self.my_doutdx[elem] = self.compute_doutdx(elem)
             return self.my_doutdx[elem]
         return self.compute_doutdx(elem)
 
     def compute_doutdx(self, elem):
-
+        # sum over every path from [elem] to this neuron, see compute_dzdx
         sigDev = (self.output())*(1-self.output())
-        weights = self.get_weights
-
-        if (self.has_weight(elem)):
-            for i in range(0,len(self.get_inputs())):
-                if (self.get_weights()[i] == elem):
-                    return (sigDev * (self.get_inputs()[i].output()))
-        else :
-            inNeurons = self.get_inputs()
-            inWeights = self.get_weights()
-            dev = 0
-            for i in range(len(self.get_weights())):
-                if (self.isa_descendant_weight_of(elem, inWeights[i])):
-                    input_deriv = self.get_inputs()[i].dOutdX(elem)
-                    dev = (sigDev * ((self.get_weights()[i]).get_value()) * (inNeurons[i]).dOutdX(elem))
-        return dev
-
-        # raise NotImplementedError("Implement me!")
+        return sigDev*self.compute_dzdx(elem)
+
+    def compute_dzdx(self, elem):
+        """
+        Computes dz/d[elem], z being this neuron's net input, i.e.
+        dOutdX without the sigmoid derivative of this neuron.
+        """
+        dz = 0.0
+        for inp, w in zip(self.get_inputs(), self.get_weights()):
+            if w is elem:
+                dz += inp.output()
+            elif self.isa_descendant_weight_of(elem, w):
+                dz += w.get_value()*inp.dOutdX(elem)
+        return dz
 
     def get_weights(self):
         return self.my_weights
@@ -233,51 +307,235 @@ class PerformanceElem(DifferentiableElement):
     desired output (d) and also computing the final
     performance P of the network.
     This implementation assumes a single output.
+    The input of a DenseNetwork's element is None until its object
+    view is built.
     """
     def __init__(self,input,desired_value):
-        assert isinstance(input,(Input,Neuron))
+        assert input is None or isinstance(input,(Input,Neuron))
         DifferentiableElement.__init__(self)
         self.my_input = input
         self.my_desired_val = desired_value
+        self.my_neuron_order = None
+        self.my_clock = [0]
+        self.my_gradients = None
+        self.clear_cache()
+
     def output(self):
         return -0.5*((self.my_desired_val)-(self.my_input.output()))**2
 
+    def output_gradient(self):
+        """Returns dP/dy, y being the output of the input element."""
+        return self.my_desired_val - self.my_input.output()
+
+    def evaluate_batch(self, desired, outputs):
+        """
+        Scores a batch of network [outputs] against the [desired] values
+        at once. Returns the performance summed over the last axis and
+        the elementwise dP/dy array.
+        """
+        error = np.asarray(desired, dtype=float) - outputs
+        return np.sum(-0.5*error**2, axis=-1), error
+
+    def sigmoid_gradient(self):
+        """
+        Returns dP/dz, z being the net input of the sigmoid Neuron that
+        feeds this element. Back-propagation starts from this value.
+        """
+        y = self.my_input.output()
+        return self.output_gradient()*y*(1 - y)
+
+    def evaluate_batch_sigmoid(self, desired, outputs):
+        """
+        Same as evaluate_batch() for [outputs] of a sigmoid neuron, but
+        returns dP/dz of its net input z instead of dP/dy.
+        """
+        performance, gradient = self.evaluate_batch(desired, outputs)
+        return performance, gradient*outputs*(1 - outputs)
+
+    def penalty(self, params):
+        """
+        Returns the weight penalty subtracted from every sample's
+        performance, for the parameter vector(s) [params] (summed over
+        the last axis). Unregularized performance elements have none.
+        """
+        return 0.0
+
+    def penalty_gradient(self, params):
+        """Returns d(penalty)/d[params]."""
+        return 0.0
+
+    def attach(self, network):
+        """Called by [network] once its parameter buffer is set up."""
+        pass
+
 
     def dOutdX(self, elem):
+        # a view over the single backward sweep done by gradients()
+        return self.gradients().get(elem, 0)
+
+    def compute_doutdx(self, elem):
+        """
+        Computes dP/d[elem] by recursing through Neuron.dOutdX.
+        This is the per-weight path used before gradients() existed.
+        """
         myInput = self.get_input()
-        return ((self.my_desired_val - self.my_input.output())*myInput.dOutdX(elem))
+        return self.output_gradient()*myInput.dOutdX(elem)
+
+    def gradients(self):
+        """
+        Returns a dict mapping every Weight feeding into this element
+        to dP/dw for the current inputs and desired value. The result
+        is cached until Network.clear_cache() or set_desired(), or,
+        outside a Network, until the input neuron's own clear_cache().
+        """
+        myInput = self.my_input
+        if (self.my_gradients_epoch != self.my_clock[0]
+            or (isinstance(myInput, Neuron)
+                and myInput.my_output_epoch != myInput.my_clock[0])):
+            gradients = self.compute_gradients()
+            if not getattr(self.my_input, 'use_cache', True):
+                return gradients
+            self.my_gradients = gradients
+            self.my_gradients_epoch = self.my_clock[0]
+        return self.my_gradients
+
+    def compute_gradients(self):
+        """
+        Back-propagates dP/dz from the output neuron towards the inputs
+        in one reverse topological sweep. Each neuron's delta is summed
+        over all its consumers once and reused for all its weights.
+        """
+        gradients = {}
+        if not isinstance(self.my_input, Neuron):
+            return gradients
+        delta = {}
+        for n in reversed(self.get_neuron_order()):
+            out = n.output()
+            dz = delta.get(n, 0.0)*out*(1 - out)
+            if n is self.my_input:
+                dz += self.sigmoid_gradient()
+            for inp, w in zip(n.get_inputs(), n.get_weights()):
+                gradients[w] = gradients.get(w, 0.0) + dz*inp.output()
+                if isinstance(inp, Neuron):
+                    delta[inp] = delta.get(inp, 0.0) + dz*w.get_value()
+        return gradients
+
+    def get_neuron_order(self):
+        """Returns the neurons feeding into this element, inputs first."""
+        if self.my_neuron_order is None:
+            self.my_neuron_order = topological_order(upstream_neurons(self.my_input))
+        return self.my_neuron_order
+
+    def clear_cache(self):
+        self.my_gradients_epoch = None
 
     def set_desired(self,new_desired):
         self.my_desired_val = new_desired
+        self.my_gradients_epoch = None
 
     def get_input(self):
         return self.my_input
 
 
-# class RegularizedPerformanceElem(PerformanceElem):
-#     def __init__(self, input, desired_value):
-#         if(type(Input) == Neuron):
-#             return 0
-#         DifferentiableElement.__init__(self)
-#         self.my_input = input
-#         self.my_desired_val = desired_value
-#         self.lambda__ = 0.0001
-#         self.weights = None
+class CrossEntropyPerformanceElem(PerformanceElem):
+    """
+    Performance P = d*log(y) + (1 - d)*log(1 - y), the negated
+    cross-entropy of a sigmoid output y against a 0/1 desired value d.
+    Its gradient through the sigmoid is simply d - y, so it does not
+    stall when the output saturates on the wrong side. y is clipped to
+    [epsilon, 1 - epsilon] only inside the logs and in dP/dy, which is
+    not used when the input is a sigmoid Neuron.
+    """
+    epsilon = 1e-12
 
-#     def set_weights(self, Weight):
-#         self.weights = Weight
+    def output(self):
+        y = min(max(self.my_input.output(), self.epsilon), 1 - self.epsilon)
+        d = self.my_desired_val
+        return d*math.log(y) + (1 - d)*math.log(1 - y)
 
-#     def output(self):
-#         old_out = -0.5 * ((self.my_desired_val - self.my_input.output()) ** 2)
-#         np_w = np.array([item.get_value() for item in self.weights])
-#         OutPut = old_out - self.lambda__ * (np.linalg.norm(np_w))
-#         return OutPut
-        
-#     def dOutdX(self, elem):
-#         old_dout = (self.my_desired_val - self.my_input.output()) * \
-#             self.my_input.dOutdX(elem)
-#         dout = old_dout - self.lambda__ * elem.get_value() * 2
-#         return dout
+    def output_gradient(self):
+        y = min(max(self.my_input.output(), self.epsilon), 1 - self.epsilon)
+        return (self.my_desired_val - y)/(y*(1 - y))
+
+    def evaluate_batch(self, desired, outputs):
+        d = np.asarray(desired, dtype=float)
+        y = np.clip(outputs, self.epsilon, 1 - self.epsilon)
+        performance = d*np.log(y) + (1 - d)*np.log(1 - y)
+        return np.sum(performance, axis=-1), (d - y)/(y*(1 - y))
+
+    def sigmoid_gradient(self):
+        return self.my_desired_val - self.my_input.output()
+
+    def evaluate_batch_sigmoid(self, desired, outputs):
+        d = np.asarray(desired, dtype=float)
+        y = np.clip(outputs, self.epsilon, 1 - self.epsilon)
+        performance = d*np.log(y) + (1 - d)*np.log(1 - y)
+        return np.sum(performance, axis=-1), d - outputs
+
+    def compute_doutdx(self, elem):
+        myInput = self.get_input()
+        if isinstance(myInput, Neuron):
+            return self.sigmoid_gradient()*myInput.compute_dzdx(elem)
+        return PerformanceElem.compute_doutdx(self, elem)
+
+
+class RegularizedPerformanceElem(PerformanceElem):
+    """
+    Squared-error performance minus a weight penalty:
+    P = -0.5*(d - y)**2 - lambda_*sum(w**2) for penalty='l2', or
+    - lambda_*sum(|w|) for penalty='l1'. The penalty and its gradient
+    are computed from the network's parameter buffer, once per
+    evaluation rather than once per weight.
+    """
+    def __init__(self, input, desired_value, lambda_=0.0001, penalty='l2'):
+        if penalty not in ('l1', 'l2'):
+            raise ValueError("penalty must be 'l1' or 'l2', not %r" %(penalty,))
+        PerformanceElem.__init__(self, input, desired_value)
+        self.lambda__ = lambda_
+        self.penalty_kind = penalty
+        self.my_network = None
+        self.my_penalty_epoch = None
+        self.my_penalty = 0.0
+
+    def attach(self, network):
+        self.my_network = network
+
+    def get_parameters(self):
+        if self.my_network is None:
+            raise Exception("%s must be part of a Network to be regularized"
+                            %(type(self).__name__))
+        return self.my_network.parameters
+
+    def penalty(self, params):
+        if self.penalty_kind == 'l2':
+            return self.lambda__*np.sum(np.square(params), axis=-1)
+        return self.lambda__*np.sum(np.abs(params), axis=-1)
+
+    def penalty_gradient(self, params):
+        if self.penalty_kind == 'l2':
+            return 2*self.lambda__*params
+        return self.lambda__*np.sign(params)
+
+    def output(self):
+        if self.my_penalty_epoch != self.my_clock[0]:
+            self.my_penalty = self.penalty(self.get_parameters())
+            self.my_penalty_epoch = self.my_clock[0]
+        return PerformanceElem.output(self) - self.my_penalty
+
+    def compute_doutdx(self, elem):
+        penalty = self.penalty_gradient(self.get_parameters()[elem.my_index])
+        return PerformanceElem.compute_doutdx(self, elem) - penalty
+
+    def compute_gradients(self):
+        gradients = PerformanceElem.compute_gradients(self)
+        penalty = self.penalty_gradient(self.get_parameters())
+        for w in gradients:
+            gradients[w] -= penalty[w.my_index]
+        return gradients
+
+    def clear_cache(self):
+        PerformanceElem.clear_cache(self)
+        self.my_penalty_epoch = None
 
 
 
@@ -288,29 +546,741 @@ class Network(object):
         self.weights = []
         self.performance = performance_node
         self.output = performance_node.get_input()
-        self.neurons = neurons[:]
-        self.neurons.sort(key=functools.cmp_to_key(alphabetize))
+        by_name, order = neuron_layout(neurons)
+        self.neurons = [neurons[k] for k in by_name]
+        self.neuron_order = [self.neurons[k] for k in order]
+        seen = set()
         for neuron in self.neurons:
-            self.weights.extend(neuron.get_weights())
+            self.weights += neuron.get_weight_nodes()
             for i in neuron.get_inputs():
-                if isinstance(i,Input) and not ('i0' in i.get_name()) and not i in self.inputs:
+                if isinstance(i,Input) and not ('i0' in i.get_name()) and not i in seen:
+                    seen.add(i)
                     self.inputs.append(i)
-        self.weights.reverse()
-        self.weights = []
+        # all weight values live in one contiguous buffer:
+        # row 0 holds the values, row 1 the next values
+        self.buffer = np.empty((2, len(self.weights)))
+        for k in range(len(self.weights)):
+            self.weights[k].bind(self.buffer, k)
+        self.compiled_net = None
+        self.performance.attach(self)
+        index_connectivity(self.neurons, self.weights, self.neuron_order)
+        # bumping the shared clock invalidates every cached value at once
+        self.clock = [0]
         for n in self.neurons:
-            self.weights += n.get_weight_nodes()
+            n.my_clock = self.clock
+        self.performance.my_clock = self.clock
 
     @classmethod
     def from_layers(self,performance_node,layers):
+        """Builds a Network from [layers], lists of Neurons ordered from
+        the inputs outwards."""
         neurons = []
         for layer in layers:
-            if layer.get_name() != 'l0':
-                neurons.extend(layer.get_elements())
+            neurons.extend(layer)
         return Network(performance_node, neurons)
 
     def clear_cache(self):
+        self.clock[0] += 1
+
+    @property
+    def parameters(self):
+        # a view taken on each access, so it follows the buffer through
+        # deepcopy and pickling instead of going stale
+        return self.buffer[0]
+
+    def get_parameters(self):
+        """
+        Returns all weight values as one float64 array, ordered like
+        network.weights. This is the live buffer the weights read from,
+        not a copy; take .copy() to keep a snapshot.
+        """
+        return self.parameters
+
+    def set_parameters(self, vec):
+        """Copies [vec], ordered like network.weights, into every weight."""
+        vec = np.asarray(vec, dtype=float)
+        if vec.shape != self.parameters.shape:
+            raise ValueError("expected %d parameters, got %s"
+                             %(len(self.parameters), vec.shape))
+        self.parameters[:] = vec
+
+    def parameter_names(self):
+        """Returns the weight names in parameter vector order."""
+        return [w.get_name() for w in self.weights]
+
+    def predict_batch(self, X):
+        """
+        Returns the network output for every row of the (N, inputs)
+        array [X], computed in one vectorized forward pass.
+        """
+        return self.compile().forward(X)
+
+    def compile(self):
+        """
+        Returns the CompiledNetwork for this network, loaded with the
+        current weight values. The compiled form is built once and reused.
+        """
+        if self.compiled_net is None:
+            self.compiled_net = CompiledNetwork(self)
+        self.compiled_net.load_weights()
+        return self.compiled_net
+
+    def save(self, path):
+        """
+        Writes the architecture and all weight values to the .npz file
+        [path] (NumPy adds the extension if it is missing). Only arrays
+        of names, indices and floats are stored, so loading needs no
+        pickle.
+        """
+        index = {}
+        for k in range(len(self.neurons)):
+            index[self.neurons[k]] = k
+        variable = set(self.inputs)
+        sources, targets, constants = [], [], {}
         for n in self.neurons:
-            n.clear_cache()
+            for i in n.get_inputs():
+                sources.append(i.get_name())
+                targets.append(index[n])
+                if isinstance(i, Input) and i not in variable:
+                    constants[i.get_name()] = i.get_value()
+        np.savez(path,
+                 kind=np.array('network'),
+                 neurons=np.array([n.get_name() for n in self.neurons], dtype=str),
+                 order=np.array([index[n] for n in self.neuron_order], dtype=int),
+                 output=np.array(index[self.output]),
+                 inputs=np.array([i.get_name() for i in self.inputs], dtype=str),
+                 constants=np.array(list(constants.keys()), dtype=str),
+                 constant_values=np.array(list(constants.values()), dtype=float),
+                 sources=np.array(sources, dtype=str),
+                 targets=np.array(targets, dtype=int),
+                 names=np.array(self.parameter_names(), dtype=str),
+                 parameters=self.parameters,
+                 **performance_state(self.performance))
+
+    @classmethod
+    def load(self, path, net_fn=None):
+        """
+        Reads a network written by save(). Its weight names must follow
+        the builders' conventions. The architecture is rebuilt from the
+        file, or with [net_fn] the network is net_fn() given the saved
+        weights by name, as make_net_with_init_weights_from_dict does.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['kind']) != 'network':
+                raise ValueError("%s holds a %s, not a network"
+                                 %(path, data['kind']))
+            neuron_names = [str(name) for name in data['neurons']]
+            inputs = [str(name) for name in data['inputs']]
+            constants = [str(name) for name in data['constants']]
+            sources = [str(name) for name in data['sources']]
+            targets = data['targets'].tolist()
+            names = [str(name) for name in data['names']]
+            parameters = data['parameters']
+            check_weight_names(names, sources,
+                               [neuron_names[t] for t in targets],
+                               inputs, constants)
+            if net_fn is not None:
+                return make_net_with_init_weights_from_dict(
+                    net_fn, dict(zip(names, parameters)))
+
+            elements = {}
+            for name in inputs:
+                elements[name] = Input(name, 0.0)
+            for name, value in zip(constants, data['constant_values']):
+                elements[name] = Input(name, float(value))
+            wiring = [[] for _ in neuron_names]
+            for k in range(len(targets)):
+                wiring[targets[k]].append(k)
+            neurons = [None]*len(neuron_names)
+            # create each neuron after the neurons feeding it
+            for t in data['order'].tolist():
+                neurons[t] = Neuron(neuron_names[t],
+                                    [elements[sources[k]] for k in wiring[t]],
+                                    [Weight(names[k], float(parameters[k]))
+                                     for k in wiring[t]])
+                elements[neuron_names[t]] = neurons[t]
+            P = load_performance(data, neurons[int(data['output'])])
+        return Network(P, neurons)
+
+
+def performance_state(element):
+    """Returns the arrays save() stores to recreate performance [element]."""
+    state = {'performance': np.array(type(element).__name__)}
+    if isinstance(element, RegularizedPerformanceElem):
+        state['lambda_'] = np.array(element.lambda__)
+        state['penalty'] = np.array(element.penalty_kind)
+    return state
+
+def load_performance(data, input):
+    """Recreates the performance element saved in [data], fed by [input]."""
+    kind = str(data['performance'])
+    if kind == 'RegularizedPerformanceElem':
+        return RegularizedPerformanceElem(input, 0.0, float(data['lambda_']),
+                                          str(data['penalty']))
+    elements = {'PerformanceElem': PerformanceElem,
+                'CrossEntropyPerformanceElem': CrossEntropyPerformanceElem}
+    if kind not in elements:
+        raise ValueError("unknown performance element %s" %(kind))
+    return elements[kind](input, 0.0)
+
+def check_weight_names(names, sources, targets, inputs, constants):
+    """
+    Raises ValueError unless the weights are uniquely named the way
+    make_net_with_init_weights_from_dict expects: 'w' + from + to, from
+    being an input's number or a neuron's name, and 'w' + to for the
+    weight of a constant threshold input. [sources] and [targets] name
+    the two ends of each weight.
+    """
+    if len(set(names)) != len(names):
+        raise ValueError("weight names are not unique")
+    inputs = set(inputs)
+    constants = set(constants)
+    for name, source, target in zip(names, sources, targets):
+        if source in constants:
+            expected = 'w' + target
+        elif source in inputs:
+            expected = 'w' + source[1:] + target
+        else:
+            expected = 'w' + source + target
+        if name != expected:
+            raise ValueError("weight %s from %s to %s should be named %s"
+                             %(name, source, target, expected))
+
+def load_network(path):
+    """Loads a Network or DenseNetwork, whichever was saved to [path]."""
+    with np.load(path, allow_pickle=False) as data:
+        kind = str(data['kind'])
+    if kind == 'dense':
+        return DenseNetwork.load(path)
+    return Network.load(path)
+
+
+# architecture signature -> neuron_layout() of that architecture
+layout_cache = {}
+layout_cache_size = 64
+
+def neuron_layout(neurons):
+    """
+    Returns the positions of [neurons] sorted by name and a topological
+    order of them, given as positions into that sorted list. Layouts are
+    cached by the names of every neuron and its inputs, so building the
+    same architecture again costs a single pass over its connections.
+    """
+    names = []
+    signature = []
+    for n in neurons:
+        names.append(n.get_name())
+        signature.append((names[-1],
+                          tuple([i.get_name() for i in n.get_inputs()])))
+    signature = tuple(signature)
+    layout = layout_cache.get(signature)
+    if layout is None:
+        by_name = sorted(range(len(neurons)), key=names.__getitem__)
+        ordered = [neurons[k] for k in by_name]
+        position = {}
+        for k in range(len(ordered)):
+            position[ordered[k]] = k
+        layout = (by_name, [position[n] for n in topological_order(ordered)])
+        # names only identify the wiring when they are unique
+        if len(set(names)) == len(names):
+            if len(layout_cache) >= layout_cache_size:
+                layout_cache.clear()
+            layout_cache[signature] = layout
+    return layout
+
+def index_connectivity(neurons, weights, order=None):
+    """
+    Numbers [weights] and [neurons] with integer ids and precomputes,
+    for each neuron, the bitset of weight ids reachable through each of
+    its direct weights, so descendant checks are single bit tests.
+    [weights] must hold every weight of [neurons], [order] is their
+    topological order if already known.
+    """
+    for k in range(len(weights)):
+        weights[k].my_id = k
+    reach = {}
+    if order is None:
+        order = topological_order(neurons)
+    for k in range(len(order)):
+        n = order[k]
+        n.my_id = k
+        n.my_weight_reach = {}
+        bits = 0
+        for i, w in zip(n.get_inputs(), n.get_weights()):
+            below = reach.get(i, 0)
+            n.my_weight_reach[w.my_id] = below
+            bits |= below | (1 << w.my_id)
+        reach[n] = bits
+
+def upstream_neurons(node):
+    """Returns [node] (if it is a Neuron) and every Neuron feeding it."""
+    found = []
+    seen = set()
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if isinstance(n, Neuron) and n not in seen:
+            seen.add(n)
+            found.append(n)
+            stack.extend(n.get_inputs())
+    return found
+
+def sigmoid(z):
+    return 1.0/(1.0 + np.exp(-z))
+
+def topological_order(neurons):
+    """
+    Orders [neurons] so that every neuron comes after all the neurons
+    feeding into it. Neurons that do not depend on each other keep
+    their relative order from [neurons].
+    """
+    position = {}
+    for n in neurons:
+        position[n] = len(position)
+    pending = {}
+    consumers = {}
+    for n in neurons:
+        count = 0
+        for i in n.get_inputs():
+            if i in position:
+                count += 1
+                consumers.setdefault(i, []).append(n)
+        pending[n] = count
+    # a heap of positions hands out the earliest ready neuron first
+    ready = [position[n] for n in neurons if pending[n] == 0]
+    heapq.heapify(ready)
+    ordered = []
+    while ready:
+        n = neurons[heapq.heappop(ready)]
+        ordered.append(n)
+        for c in consumers.get(n, ()):
+            pending[c] -= 1
+            if pending[c] == 0:
+                heapq.heappush(ready, position[c])
+    if len(ordered) != len(neurons):
+        raise Exception("network contains a cycle")
+    return ordered
+
+
+class CompiledNetwork(object):
+    """
+    A Network flattened into a topologically ordered stack of dense
+    layers. Each layer holds a weight matrix over the columns of all
+    earlier layers (the network inputs first) and a bias vector that
+    folds in the constant -1 threshold inputs, so a forward pass over
+    a batch of samples is one matrix multiply per layer.
+
+    The flat vector [params] is network.parameters, which mirrors
+    network.weights position by position and is the buffer the Weight
+    objects read from, so trained values show up in them directly.
+    """
+    def __init__(self, network):
+        self.network = network
+        self.weights = network.weights
+        self.n_inputs = len(network.inputs)
+        weight_index = {}
+        for k in range(len(self.weights)):
+            weight_index[self.weights[k]] = k
+
+        # group neurons into layers by their distance from the inputs
+        depth = {}
+        layers = []
+        for n in network.neuron_order:
+            d = 0
+            for i in n.get_inputs():
+                if i in depth:
+                    d = max(d, depth[i] + 1)
+            depth[n] = d
+            if d == len(layers):
+                layers.append([])
+            layers[d].append(n)
+
+        self.columns = {}
+        for i in range(self.n_inputs):
+            self.columns[network.inputs[i]] = i
+        self.n_columns = self.n_inputs
+        self.layers = []
+        for neurons in layers:
+            start = self.n_columns
+            w_rows, w_cols, w_index = [], [], []
+            b_rows, b_index, b_const = [], [], []
+            for row in range(len(neurons)):
+                n = neurons[row]
+                for i, w in zip(n.get_inputs(), n.get_weights()):
+                    if i in self.columns:
+                        w_rows.append(row)
+                        w_cols.append(self.columns[i])
+                        w_index.append(weight_index[w])
+                    else:
+                        # an Input outside network.inputs is a constant
+                        b_rows.append(row)
+                        b_index.append(weight_index[w])
+                        b_const.append(i.get_value())
+                self.columns[n] = start + row
+            self.n_columns += len(neurons)
+            self.layers.append({
+                'start': start,
+                'size': len(neurons),
+                'neurons': neurons,
+                'w_rows': np.array(w_rows, dtype=int),
+                'w_cols': np.array(w_cols, dtype=int),
+                'w_index': np.array(w_index, dtype=int),
+                'b_rows': np.array(b_rows, dtype=int),
+                'b_index': np.array(b_index, dtype=int),
+                'b_const': np.array(b_const, dtype=float),
+                'W': np.zeros((len(neurons), start)),
+                'b': np.zeros(len(neurons)),
+            })
+        self.output_column = self.columns[network.output]
+
+    @property
+    def params(self):
+        return self.network.parameters
+
+    def assemble(self):
+        """Scatters [params] into the dense layer matrices and biases."""
+        for layer in self.layers:
+            W = layer['W']
+            W.fill(0.0)
+            W[layer['w_rows'], layer['w_cols']] = self.params[layer['w_index']]
+            b = layer['b']
+            b.fill(0.0)
+            np.add.at(b, layer['b_rows'],
+                      self.params[layer['b_index']] * layer['b_const'])
+
+    def load_weights(self):
+        """Picks up changes made through the Weight objects."""
+        self.assemble()
+
+    def store_weights(self):
+        """
+        Makes [params] visible through the Weight objects. They already
+        share the buffer, so only weights that were since bound to
+        another network need their value copied.
+        """
+        for k in range(len(self.weights)):
+            if self.weights[k].my_buffer is not self.network.buffer:
+                self.weights[k].set_value(self.params[k])
+
+    def activations(self, X):
+        """
+        Runs the forward pass over the (N, inputs) array [X] and returns
+        the (N, columns) array of inputs followed by every neuron output.
+        """
+        X = np.asarray(X, dtype=float).reshape(-1, self.n_inputs)
+        A = np.empty((X.shape[0], self.n_columns))
+        A[:, :self.n_inputs] = X
+        for layer in self.layers:
+            start = layer['start']
+            z = A[:, :start].dot(layer['W'].T) + layer['b']
+            A[:, start:start + layer['size']] = sigmoid(z)
+        return A
+
+    def forward(self, X):
+        """Returns the network output for each row of [X]."""
+        return self.activations(X)[:, self.output_column]
+
+    def forward_many(self, param_sets, X):
+        """
+        Evaluates [X] under each row of the (K, params) array [param_sets]
+        in one batched pass, without touching [params]. Returns the
+        (K, N) outputs.
+        """
+        param_sets = np.atleast_2d(param_sets)
+        X = np.asarray(X, dtype=float).reshape(-1, self.n_inputs)
+        K = len(param_sets)
+        A = np.empty((K, X.shape[0], self.n_columns))
+        A[:, :, :self.n_inputs] = X
+        for layer in self.layers:
+            start, size = layer['start'], layer['size']
+            W = np.zeros((K, size, start))
+            W[:, layer['w_rows'], layer['w_cols']] = param_sets[:, layer['w_index']]
+            # sum each neuron's constant-input terms into its bias
+            gather = np.zeros((len(layer['b_rows']), size))
+            gather[np.arange(len(layer['b_rows'])), layer['b_rows']] = 1.0
+            b = (param_sets[:, layer['b_index']]*layer['b_const']).dot(gather)
+            z = np.matmul(A[:, :, :start], W.transpose(0, 2, 1)) + b[:, None, :]
+            A[:, :, start:start + size] = sigmoid(z)
+        return A[:, :, self.output_column]
+
+    def backward(self, X, desired, A=None):
+        """
+        Runs the forward pass over [X] (unless its activations [A] are
+        given) and back-propagates the network's performance element,
+        scored against the vector [desired] with one
+        evaluate_batch_sigmoid() call. Returns the outputs y, the summed performance and
+        dP/d[params] summed over the batch. A weight penalty counts
+        once per row, like in the per-sample performance, but is
+        computed once for the batch.
+        """
+        if A is None:
+            A = self.activations(X)
+        outputs = A[:, self.output_column]
+        performance, output_dz = \
+            self.network.performance.evaluate_batch_sigmoid(desired, outputs)
+        delta = np.zeros_like(A)
+        gradient = np.zeros(len(self.params))
+        for layer in reversed(self.layers):
+            start = layer['start']
+            out = A[:, start:start + layer['size']]
+            dz = delta[:, start:start + layer['size']]*out*(1 - out)
+            if start <= self.output_column < start + layer['size']:
+                dz[:, self.output_column - start] += output_dz
+            delta[:, :start] += dz.dot(layer['W'])
+            dW = dz.T.dot(A[:, :start])
+            np.add.at(gradient, layer['w_index'],
+                      dW[layer['w_rows'], layer['w_cols']])
+            np.add.at(gradient, layer['b_index'],
+                      dz.sum(axis=0)[layer['b_rows']]*layer['b_const'])
+        element = self.network.performance
+        performance -= len(outputs)*element.penalty(self.params)
+        gradient -= len(outputs)*element.penalty_gradient(self.params)
+        return outputs, performance, gradient
+
+
+class DenseNetwork(object):
+    """
+    A fully connected sigmoid network given by its layer sizes, such as
+    [2, 40, 1], built directly in compiled form: every layer is a view
+    of shape (size, previous size + 1) into one parameter vector, the
+    last column holding the weight of the constant -1 threshold input.
+    No Neuron or Weight objects are made, so it also serves as its own
+    CompiledNetwork and trains in batches (one row at a time by default).
+
+    The parameters are in the order a Network of the same shape would
+    use, and parameter_names() spells out the usual names: inputs
+    'i1', 'i2', ..., one letter per layer ('A' closest to the inputs)
+    with a zero-padded unit number in layers wider than one ('A01' to
+    'A40'), weights 'w' + from + to and threshold weights 'w' + to.
+    as_network() builds that Network on demand, sharing the parameters.
+    """
+    def __init__(self, sizes, performance=None, seed=0):
+        sizes = [int(size) for size in sizes]
+        if len(sizes) < 2 or min(sizes) < 1:
+            raise ValueError("need at least an input and an output layer, got %s"
+                             %(sizes,))
+        if sizes[-1] != 1:
+            raise ValueError("the output layer must have a single unit, got %d"
+                             %(sizes[-1]))
+        if len(sizes) > 27:
+            raise ValueError("at most 26 layers of neurons can be named")
+        self.sizes = sizes
+        self.inputs = [Input('i%d' %(k + 1), 0.0) for k in range(sizes[0])]
+        self.n_inputs = sizes[0]
+        self.n_columns = sum(sizes)
+        if performance is None:
+            performance = PerformanceElem(None, 0.0)
+        self.performance = performance
+
+        n = 0
+        for k in range(1, len(sizes)):
+            n += sizes[k]*(sizes[k - 1] + 1)
+        self.buffer = np.empty((2, n))
+        self.buffer[1] = np.nan
+        # draw from {-1, 0, 1} like random_weight()
+        rng = np.random.default_rng(seed)
+        self.parameters[:] = rng.integers(-1, 2, size=n)
+        self.network = None
+        self.performance.attach(self)
+
+    def __repr__(self):
+        return "DenseNetwork(%s, %d weights)" %(self.sizes, len(self.parameters))
+
+    # the parameter vector and layer matrices are views of [buffer] taken
+    # on each access, so they follow it through deepcopy and pickling
+    @property
+    def parameters(self):
+        return self.buffer[0]
+
+    @property
+    def params(self):
+        return self.buffer[0]
+
+    @property
+    def matrices(self):
+        matrices = []
+        start = 0
+        for k in range(1, len(self.sizes)):
+            shape = (self.sizes[k], self.sizes[k - 1] + 1)
+            matrices.append(self.buffer[0, start:start + shape[0]*shape[1]]
+                            .reshape(shape))
+            start += shape[0]*shape[1]
+        return matrices
+
+    def clear_cache(self):
+        pass
+
+    def get_parameters(self):
+        """
+        Returns the live parameter vector, ordered like parameter_names();
+        take .copy() to keep a snapshot.
+        """
+        return self.parameters
+
+    def set_parameters(self, vec):
+        """Copies [vec], ordered like parameter_names(), into the parameters."""
+        vec = np.asarray(vec, dtype=float)
+        if vec.shape != self.parameters.shape:
+            raise ValueError("expected %d parameters, got %s"
+                             %(len(self.parameters), vec.shape))
+        self.parameters[:] = vec
+
+    def save(self, path):
+        """Writes the layer sizes and parameters to the .npz file [path]."""
+        np.savez(path,
+                 kind=np.array('dense'),
+                 sizes=np.array(self.sizes, dtype=int),
+                 parameters=self.parameters,
+                 **performance_state(self.performance))
+
+    @classmethod
+    def load(self, path):
+        """Reads a DenseNetwork written by save()."""
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['kind']) != 'dense':
+                raise ValueError("%s holds a %s, not a dense network"
+                                 %(path, data['kind']))
+            network = DenseNetwork(data['sizes'].tolist(),
+                                   load_performance(data, None))
+            network.set_parameters(data['parameters'])
+        return network
+
+    def unit_names(self):
+        """
+        Returns the identifiers of each layer's units as used in weight
+        names: '1', '2', ... for the inputs, then 'A01', 'A02', ..., 'B'.
+        """
+        names = [[str(k + 1) for k in range(self.sizes[0])]]
+        for k in range(1, len(self.sizes)):
+            letter = chr(ord('A') + k - 1)
+            size = self.sizes[k]
+            if size == 1:
+                names.append([letter])
+            else:
+                digits = len(str(size))
+                names.append(["%s%0*d" %(letter, digits, u + 1)
+                              for u in range(size)])
+        return names
+
+    def parameter_names(self):
+        """Returns the weight names in parameter vector order."""
+        names = []
+        units = self.unit_names()
+        for k in range(1, len(units)):
+            for to in units[k]:
+                names.extend(['w' + fr + to for fr in units[k - 1]])
+                names.append('w' + to)
+        return names
+
+    def as_network(self):
+        """
+        Returns the equivalent Network of named Inputs, Weights and
+        Neurons, built on first use. It shares this network's inputs,
+        performance element and parameter buffer.
+        """
+        if self.network is None:
+            i0 = Input('i0', -1.0)
+            names = self.parameter_names()
+            units = self.unit_names()
+            previous = self.inputs
+            layers = []
+            k = 0
+            for l in range(1, len(units)):
+                layer = []
+                for to in units[l]:
+                    weights = []
+                    for j in range(len(previous) + 1):
+                        weights.append(Weight(names[k], float(self.parameters[k])))
+                        k += 1
+                    layer.append(Neuron(to, previous + [i0], weights))
+                layers.append(layer)
+                previous = layer
+            self.performance.my_input = previous[0]
+            network = Network.from_layers(self.performance, layers)
+            # unit names sort in layer order, so network.weights is in
+            # parameter order and can move onto this buffer as is
+            for k in range(len(network.weights)):
+                network.weights[k].bind(self.buffer, k)
+            network.buffer = self.buffer
+            self.performance.attach(self)
+            self.network = network
+        return self.network
+
+    def predict_batch(self, X):
+        """Returns the network output for every row of the (N, inputs) array [X]."""
+        return self.forward(X)
+
+    def compile(self):
+        """A DenseNetwork is already in compiled form."""
+        return self
+
+    def assemble(self):
+        """The layer matrices are views of [params], nothing to scatter."""
+        pass
+
+    def load_weights(self):
+        pass
+
+    def store_weights(self):
+        pass
+
+    def activations(self, X):
+        """
+        Runs the forward pass over the (N, inputs) array [X] and returns
+        the list of per-layer outputs, [X] first.
+        """
+        A = [np.asarray(X, dtype=float).reshape(-1, self.n_inputs)]
+        for W in self.matrices:
+            A.append(sigmoid(A[-1].dot(W[:, :-1].T) - W[:, -1]))
+        return A
+
+    def forward(self, X):
+        """Returns the network output for each row of [X]."""
+        return self.activations(X)[-1][:, 0]
+
+    def forward_many(self, param_sets, X):
+        """
+        Evaluates [X] under each row of the (K, params) array [param_sets]
+        in one batched pass, without touching [params]. Returns the
+        (K, N) outputs.
+        """
+        param_sets = np.atleast_2d(param_sets)
+        A = np.asarray(X, dtype=float).reshape(-1, self.n_inputs)
+        start = 0
+        for W in self.matrices:
+            size = W.size
+            Ws = param_sets[:, start:start + size].reshape((-1,) + W.shape)
+            A = sigmoid(np.matmul(A, Ws[:, :, :-1].transpose(0, 2, 1))
+                        - Ws[:, None, :, -1])
+            start += size
+        return A[:, :, 0]
+
+    def backward(self, X, desired, A=None):
+        """
+        Same as CompiledNetwork.backward(): returns the outputs y, the
+        summed performance and dP/d[params] summed over the batch, with
+        a weight penalty counted once per row.
+        """
+        if A is None:
+            A = self.activations(X)
+        outputs = A[-1][:, 0]
+        performance, output_dz = \
+            self.performance.evaluate_batch_sigmoid(desired, outputs)
+        gradient = np.empty(len(self.params))
+        dz = output_dz[:, None]
+        stop = len(self.params)
+        matrices = self.matrices
+        for k in reversed(range(len(matrices))):
+            W = matrices[k]
+            dW = gradient[stop - W.size:stop].reshape(W.shape)
+            dW[:, :-1] = dz.T.dot(A[k])
+            dW[:, -1] = -dz.sum(axis=0)
+            if k:
+                dz = dz.dot(W[:, :-1])*A[k]*(1 - A[k])
+            stop -= W.size
+        performance -= len(outputs)*self.performance.penalty(self.params)
+        gradient -= len(outputs)*self.performance.penalty_gradient(self.params)
+        return outputs, performance, gradient
 
 def seed_random():
     """Seed the random number generator so that random
@@ -371,63 +1341,63 @@ def make_neural_net_basic():
     net = Network(P,[A])
     return net
 
-# def make_neural_net_two_layer():
-#     i0 = Input('i0', -1.0)
-#     i1 = Input('i1', 0)
-#     i2 = Input('i2', 0)
-#     seed_random()
-#     w1A = Weight('w1A', random_weight())
-#     w1B = Weight('w1B', random_weight())
-#     w2A = Weight('w2A', random_weight())
-#     w2B = Weight('w2B', random_weight())
-#     wA = Weight('wA', random_weight())
-#     wB = Weight('wB', random_weight())
-#     wAC = Weight('wAC', random_weight())
-#     wBC = Weight('wBC', random_weight())
-#     wC = Weight('wAC', random_weight())
-#     A = Neuron('A', [i0,i1,i2], [wA,w1A,w2A])
-#     B = Neuron('B', [i0,i1,i2], [wB,w1B,w2B])
-#     C = Neuron('C', [i0,A,B], [wC,wAC,wBC])
-#     P = PerformanceElem(C, 0.0)
-#     return Network(P,[A,B,C])
-
-
-# def make_neural_net_challenging():
-    
-#     i0 = Input('i0', -1.0)
-#     i1 = Input('i1', 0.0)
-#     i2 = Input('i2', 0.0)
-
-#     seed_random()
-#     w1A = Weight('w1A', random_weight())
-#     w1B = Weight('w1B', random_weight())
-#     w1C = Weight('w1C', random_weight())
-#     w2A = Weight('w2A', random_weight())
-#     w2B = Weight('w2B', random_weight())
-#     w2C = Weight('w2C', random_weight())
-
-#     wA = Weight('wA', random_weight())
-#     wB = Weight('wB', random_weight())
-#     wC = Weight('wC', random_weight())
-#     wD = Weight('wD', random_weight())
-#     wE = Weight('wE', random_weight())
-
-#     wAD = Weight('wAD', random_weight())
-#     wAE = Weight('wAE', random_weight())
-#     wBD = Weight('wBD', random_weight())
-#     wBE = Weight('wBE', random_weight())
-#     wCD = Weight('wCD', random_weight())
-#     wCE = Weight('wCE', random_weight())
-#     wDE = Weight('wDE', random_weight())
-
-#     A = Neuron('A', [i0,i1,i2], [wA,w1A,w2A])
-#     B = Neuron('B', [i0,i1,i2], [wB,w1B,w2B])
-#     C = Neuron('C', [i0,i1,i2], [wC,w1C,w2C])
-#     D = Neuron('D', [i0,A,B,C], [wD,wAD,wBD,wCD])
-#     E = Neuron('E', [i0,A,B,C,D], [wE,wAE,wBE,wCE,wDE])
-
-#     P = PerformanceElem(E, 0.0)
-#     return Network(P, [A,B,C,D,E])
+def make_neural_net_two_layer():
+    i0 = Input('i0', -1.0)
+    i1 = Input('i1', 0)
+    i2 = Input('i2', 0)
+    seed_random()
+    w1A = Weight('w1A', random_weight())
+    w1B = Weight('w1B', random_weight())
+    w2A = Weight('w2A', random_weight())
+    w2B = Weight('w2B', random_weight())
+    wA = Weight('wA', random_weight())
+    wB = Weight('wB', random_weight())
+    wAC = Weight('wAC', random_weight())
+    wBC = Weight('wBC', random_weight())
+    wC = Weight('wC', random_weight())
+    A = Neuron('A', [i0,i1,i2], [wA,w1A,w2A])
+    B = Neuron('B', [i0,i1,i2], [wB,w1B,w2B])
+    C = Neuron('C', [i0,A,B], [wC,wAC,wBC])
+    P = PerformanceElem(C, 0.0)
+    return Network(P,[A,B,C])
+
+
+def make_neural_net_challenging():
+
+    i0 = Input('i0', -1.0)
+    i1 = Input('i1', 0.0)
+    i2 = Input('i2', 0.0)
+
+    seed_random()
+    w1A = Weight('w1A', random_weight())
+    w1B = Weight('w1B', random_weight())
+    w1C = Weight('w1C', random_weight())
+    w2A = Weight('w2A', random_weight())
+    w2B = Weight('w2B', random_weight())
+    w2C = Weight('w2C', random_weight())
+
+    wA = Weight('wA', random_weight())
+    wB = Weight('wB', random_weight())
+    wC = Weight('wC', random_weight())
+    wD = Weight('wD', random_weight())
+    wE = Weight('wE', random_weight())
+
+    wAD = Weight('wAD', random_weight())
+    wAE = Weight('wAE', random_weight())
+    wBD = Weight('wBD', random_weight())
+    wBE = Weight('wBE', random_weight())
+    wCD = Weight('wCD', random_weight())
+    wCE = Weight('wCE', random_weight())
+    wDE = Weight('wDE', random_weight())
+
+    A = Neuron('A', [i0,i1,i2], [wA,w1A,w2A])
+    B = Neuron('B', [i0,i1,i2], [wB,w1B,w2B])
+    C = Neuron('C', [i0,i1,i2], [wC,w1C,w2C])
+    D = Neuron('D', [i0,A,B,C], [wD,wAD,wBD,wCD])
+    E = Neuron('E', [i0,A,B,C,D], [wE,wAE,wBE,wCE,wDE])
+
+    P = PerformanceElem(E, 0.0)
+    return Network(P, [A,B,C,D,E])
 
 
 
@@ -465,18 +1435,21 @@ def make_neural_net_basic():
 
 def make_net_with_init_weights_from_dict(net_fn,init_weights):
     net = net_fn()
-    for w in net.weights:
-        w.set_value(init_weights[w.get_name()])
+    net.set_parameters([init_weights[name] for name in net.parameter_names()])
     return net
 
 def make_net_with_init_weights_from_list(net_fn,init_weights):
     net = net_fn()
-    for i in range(len(net.weights)):
-        net.weights[i].set_value(init_weights[i])
+    net.set_parameters(init_weights)
     return net
 
 
-def make_neural_net_two_moons():
+def make_neural_net_two_moons(regularization=0.0, penalty='l2'):
+    """
+    Builds the 40-hidden-unit two-moons network. A non-zero
+    [regularization] trains it against a RegularizedPerformanceElem
+    with that lambda and [penalty] ('l2' or 'l1').
+    """
 
     i0 = Input('i0', -1.0)  # Bias
     i1 = Input('i1', 0.)
@@ -495,7 +1468,114 @@ def make_neural_net_two_moons():
         OutPutWeights.append(Weight("wA1"+str(i)+"B",random_weight()))
     OutPutWeights.append(Weight("wB",random_weight()))
     B = Neuron("B",firstLayer+[i0],OutPutWeights)
-    return Network(PerformanceElem(B,0.0),firstLayer+[B])
+    if regularization:
+        P = RegularizedPerformanceElem(B, 0.0, regularization, penalty)
+    else:
+        P = PerformanceElem(B,0.0)
+    return Network(P,firstLayer+[B])
+
+def make_neural_net_two_moons_regularized():
+    """The two-moons network with an L2 penalty against overfitting."""
+    return make_neural_net_two_moons(regularization=0.0001)
+
+def make_neural_net_layers(sizes, regularization=0.0, penalty='l2', seed=0):
+    """
+    Builds a fully connected DenseNetwork from its layer [sizes], e.g.
+    [2, 40, 1] for a two-moons network or [2, 1000, 1] for a much wider
+    one. [regularization] and [penalty] work as in
+    make_neural_net_two_moons, [seed] picks the initial weights.
+    """
+    if regularization:
+        P = RegularizedPerformanceElem(None, 0.0, regularization, penalty)
+    else:
+        P = PerformanceElem(None, 0.0)
+    return DenseNetwork(sizes, P, seed)
+
+
+class Optimizer(object):
+    """
+    Abstract update rule. step() moves a parameter vector in place along
+    the gradient of the performance, which training maximizes. Any state
+    is kept in arrays shaped like the parameter vector, allocated on the
+    first step and reset if the vector changes size.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.state = None
+
+    def get_state(self, params, count):
+        if self.state is None or self.state[0].shape != params.shape:
+            self.state = [np.zeros_like(params) for _ in range(count)]
+        return self.state
+
+    def step(self, params, gradient):
+        raise NotImplementedError("This is an abstract method")
+
+class SGD(Optimizer):
+    """w <- w + rate*g, the update train() has always used."""
+    def __init__(self, rate=1.0):
+        Optimizer.__init__(self, rate)
+
+    def step(self, params, gradient):
+        params += self.rate*gradient
+
+class Momentum(Optimizer):
+    """Classical momentum: v <- momentum*v + rate*g, w <- w + v."""
+    def __init__(self, rate=1.0, momentum=0.9):
+        Optimizer.__init__(self, rate)
+        self.momentum = momentum
+
+    def step(self, params, gradient):
+        velocity, = self.get_state(params, 1)
+        velocity *= self.momentum
+        velocity += self.rate*gradient
+        params += velocity
+
+class Nesterov(Momentum):
+    """
+    Nesterov momentum, in the form that only needs the gradient at the
+    current weights: w <- w + momentum*v + rate*g after updating v.
+    """
+    def step(self, params, gradient):
+        velocity, = self.get_state(params, 1)
+        velocity *= self.momentum
+        velocity += self.rate*gradient
+        params += self.momentum*velocity + self.rate*gradient
+
+class RMSProp(Optimizer):
+    """Scales each step by a running RMS of that weight's gradients."""
+    def __init__(self, rate=0.01, decay=0.9, epsilon=1e-8):
+        Optimizer.__init__(self, rate)
+        self.decay = decay
+        self.epsilon = epsilon
+
+    def step(self, params, gradient):
+        mean_square, = self.get_state(params, 1)
+        mean_square *= self.decay
+        mean_square += (1 - self.decay)*gradient**2
+        params += self.rate*gradient/(np.sqrt(mean_square) + self.epsilon)
+
+class Adam(Optimizer):
+    """Adam: bias-corrected running mean and RMS of the gradients."""
+    def __init__(self, rate=0.01, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        Optimizer.__init__(self, rate)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.steps = 0
+
+    def step(self, params, gradient):
+        if self.state is None or self.state[0].shape != params.shape:
+            self.steps = 0
+        mean, mean_square = self.get_state(params, 2)
+        self.steps += 1
+        mean *= self.beta1
+        mean += (1 - self.beta1)*gradient
+        mean_square *= self.beta2
+        mean_square += (1 - self.beta2)*gradient**2
+        m = mean/(1 - self.beta1**self.steps)
+        v = mean_square/(1 - self.beta2**self.steps)
+        params += self.rate*m/(np.sqrt(v) + self.epsilon)
 
 
 def train(network,
@@ -503,18 +1583,83 @@ def train(network,
           rate=1.0,  # learning rate
           target_abs_mean_performance=0.0001,
           max_iterations = 10000,
-          verbose=False):
+          verbose=False,
+          backprop=True,
+          batch_size=None,
+          plot=None,
+          shuffle_buffer=None,
+          optimizer=None,
+          validation_split=0.0,
+          validation_data=None,
+          patience=None,
+          restore_best=True,
+          schedule=None,
+          callbacks=None,
+          summary=True):
     """Run back-propagation training algorithm on a given network.
     with training [data].   The training runs for [max_iterations]
     or until [target_abs_mean_performance] is reached.
+    With [backprop] all weight gradients come from one backward sweep
+    per datum, otherwise each weight recurses through Neuron.dOutdX.
+    When [batch_size] is given the data is split into batches of that
+    size (use len(data) for full-batch training) and each batch makes
+    one averaged update computed on the compiled network.
+    If [plot] is a filename, the decision boundary over [data] is saved
+    there after training, rendered on a background thread. That thread
+    is returned so callers can join() it; otherwise train() returns None.
+    [data] may also be a stream: any iterable of (rows, columns) chunks
+    without a len(), such as neural_net_data.CsvChunks. It is re-iterated
+    every iteration (a plain generator therefore gives a single pass) and
+    trained on in batches of [batch_size], 1 by default, as is a
+    DenseNetwork. [shuffle_buffer] shuffles rows across chunks through
+    a buffer of that many rows.
+    [optimizer] is the update rule applied to the network's parameter
+    vector, plain SGD(rate) by default.
+    The last [validation_split] fraction of [data], or [validation_data],
+    is held out and scored after every iteration. With [patience] training
+    stops once that score has not improved for that many iterations, and
+    with [restore_best] the best-scoring weights are put back at the end.
+    [patience] without held-out data is a ValueError.
+    [schedule] (StepDecay, CosineDecay, ReduceOnPlateau) sets the
+    optimizer's rate each iteration.
+    [callbacks] are Callback objects notified at the start and end of
+    every iteration and after every update, e.g. a MetricsLogger.
+    With [summary] the trained weights and the training accuracy are
+    printed at the end.
     """
-    
+    if optimizer is None:
+        optimizer = SGD(rate)
+    streaming = not hasattr(data, '__len__')
+    if validation_split:
+        if streaming:
+            raise ValueError("validation_split needs in-memory data, "
+                             "pass validation_data for streams")
+        held_out = int(round(len(data)*validation_split))
+        if held_out and validation_data is None:
+            validation_data = data[len(data) - held_out:]
+        data = data[:len(data) - held_out]
+    if patience is not None and validation_data is None:
+        raise ValueError("patience needs held-out data: "
+                         "pass validation_split or validation_data")
+    control = TrainingControl(network, optimizer, validation_data, patience,
+                              restore_best, schedule, verbose, callbacks)
+    if batch_size is None and (streaming or isinstance(network, DenseNetwork)):
+        batch_size = 1
+    if batch_size is not None or shuffle_buffer:
+        return train_batches(network, data, rate, target_abs_mean_performance,
+                             max_iterations, verbose, batch_size or 1, plot,
+                             shuffle_buffer, optimizer, control, summary)
+
     iteration = 0
     while iteration < max_iterations:
         fully_trained = False
         performances = []  # store performance on each data point
         correct = 0
+        control.start_iteration(iteration)
+        timed = control.instrumented
         for datum in data:
+            if timed:
+                start = time.perf_counter()
             # set network inputs
             for i in range(len(network.inputs)):
                 network.inputs[i].set_value(datum[i])
@@ -532,16 +1677,29 @@ def train(network,
                 correct += 1
 
             performance_result = network.performance.output()
+            if timed:
+                forward_done = time.perf_counter()
 
 
-            # compute all the weight updates
-            for w in network.weights:
-                w.set_next_value(w.get_value() +
-                                 rate * network.performance.dOutdX(w))
+            # compute all the weight gradients
+            if backprop:
+                gradients = network.performance.gradients()
+                gradient = np.array([gradients.get(w, 0)
+                                     for w in network.weights], dtype=float)
+            else:
+                gradient = np.array([network.performance.compute_doutdx(w)
+                                     for w in network.weights], dtype=float)
 
             # set the new weights
-            for w in network.weights:
-                w.update()
+            if timed:
+                gradient_done = time.perf_counter()
+                optimizer.step(network.parameters, gradient)
+                control.add_batch(datum[-1], result, abs(performance_result),
+                                  gradient, forward_done - start,
+                                  gradient_done - forward_done,
+                                  time.perf_counter() - gradient_done)
+            else:
+                optimizer.step(network.parameters, gradient)
 
             # save the performance value
             performances.append(network.performance.output())
@@ -551,6 +1709,7 @@ def train(network,
 
         # compute the mean performance value
         abs_mean_performance = abs_mean(performances)
+        stop = control.end_iteration(iteration, abs_mean_performance)
 
         if abs_mean_performance < target_abs_mean_performance:
             if verbose:
@@ -570,40 +1729,476 @@ def train(network,
                   %(iteration,
                     abs_mean_performance))
 
-    print('weights:', network.weights)
-    print("Train Acc: ", float(correct)/len(data))
-    plot_decision_boundary(network,data)
+        if stop:
+            break
+
+    control.finish()
+    if summary:
+        print('weights:', network.weights)
+        print("Train Acc: ", float(correct)/len(data))
+    if plot:
+        return plot_decision_boundary(network, data, filename=plot,
+                                      background=True)
   
 
 
-def test(network, data, verbose=False):
-    """Test the neural net on some given data."""
-    correct = 0
-    for datum in data:
+class StepDecay(object):
+    """Multiplies the rate by [gamma] every [step_size] iterations."""
+    def __init__(self, step_size, gamma=0.5):
+        self.step_size = step_size
+        self.gamma = gamma
+
+    def __call__(self, iteration, base_rate, metric):
+        return base_rate*self.gamma**(iteration//self.step_size)
+
+class CosineDecay(object):
+    """Anneals the rate from its base value to [min_rate] over [iterations]."""
+    def __init__(self, iterations, min_rate=0.0):
+        self.iterations = iterations
+        self.min_rate = min_rate
+
+    def __call__(self, iteration, base_rate, metric):
+        progress = min(iteration, self.iterations)/float(self.iterations)
+        return self.min_rate + 0.5*(base_rate - self.min_rate)*\
+            (1 + math.cos(math.pi*progress))
+
+class ReduceOnPlateau(object):
+    """
+    Multiplies the rate by [factor] whenever the monitored performance
+    (validation if any, else training) has not improved for [patience]
+    iterations, never going below [min_rate].
+    """
+    def __init__(self, factor=0.5, patience=10, min_rate=0.0):
+        self.factor = factor
+        self.patience = patience
+        self.min_rate = min_rate
+        self.best = None
+        self.wait = 0
+        self.scale = 1.0
+
+    def __call__(self, iteration, base_rate, metric):
+        if self.best is None or metric < self.best:
+            self.best = metric
+            self.wait = 0
+        else:
+            self.wait += 1
+            if self.wait >= self.patience:
+                self.scale *= self.factor
+                self.wait = 0
+        return max(base_rate*self.scale, self.min_rate)
+
+
+class Callback(object):
+    """
+    Base class for train() hooks. Override any of the methods; [logs] is
+    a dict of the metrics gathered so far (see TrainingControl).
+    """
+    def on_epoch_start(self, epoch, logs):
+        pass
+
+    def on_batch(self, batch, logs):
+        pass
+
+    def on_epoch_end(self, epoch, logs):
+        pass
+
+    def on_train_end(self, logs):
+        pass
+
+
+class MetricsLogger(Callback):
+    """
+    Writes the per-epoch logs to [path], one JSON object per line, or as
+    CSV when [path] ends in .csv or [format] is 'csv'.
+    """
+    def __init__(self, path, format=None):
+        self.path = path
+        self.format = format or ('csv' if path.endswith('.csv') else 'jsonl')
+        self.file = None
+        self.writer = None
+
+    def on_epoch_end(self, epoch, logs):
+        if self.file is None:
+            self.file = open(self.path, 'w', newline='')
+            if self.format == 'csv':
+                self.writer = csv.DictWriter(self.file, fieldnames=list(logs),
+                                             extrasaction='ignore')
+                self.writer.writeheader()
+        if self.writer is not None:
+            self.writer.writerow(logs)
+        else:
+            self.file.write(json.dumps(logs) + "\n")
+        self.file.flush()
+
+    def on_train_end(self, logs):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.writer = None
 
-        for i in range(len(network.inputs)):
-            network.inputs[i].set_value(datum[i])
 
-        # clear cached calculations
-        network.clear_cache()
-        result = network.output.output()
-        prediction = round(result)
+class TrainingControl(object):
+    """
+    Per-iteration bookkeeping shared by train() and train_batches():
+    timing and metrics for the callbacks, scoring the validation data,
+    patience-based early stopping with a snapshot of the best
+    parameters, and the learning rate schedule.
+
+    The epoch logs hold: epoch, samples, loss (mean abs performance),
+    accuracy, forward_s, gradient_s and update_s (time spent in each
+    phase), epoch_s, samples_per_s, gradient_norm (mean L2 norm of the
+    per-update gradients), rate and, with validation data,
+    validation_performance. Batch logs hold the same per update.
+    """
+    def __init__(self, network, optimizer, validation_data=None,
+                 patience=None, restore_best=True, schedule=None,
+                 verbose=False, callbacks=None):
+        self.network = network
+        self.optimizer = optimizer
+        self.patience = patience
+        self.restore_best = restore_best
+        self.schedule = schedule
+        self.verbose = verbose
+        self.callbacks = list(callbacks or [])
+        # per-update metrics are only gathered for callbacks to read
+        self.instrumented = bool(self.callbacks)
+        self.base_rate = optimizer.rate
+        self.validation = None
+        if validation_data is not None and len(validation_data):
+            self.validation = np.asarray(validation_data, dtype=float)
+        self.best = None
+        self.best_parameters = None
+        self.wait = 0
+        self.logs = {}
+
+    def start_iteration(self, iteration):
+        self.epoch_start = time.perf_counter()
+        self.samples = 0
+        self.batches = 0
+        self.loss = 0.0
+        self.correct = 0
+        self.forward_s = 0.0
+        self.gradient_s = 0.0
+        self.update_s = 0.0
+        self.gradient_norm = 0.0
+        for callback in self.callbacks:
+            callback.on_epoch_start(iteration, {'epoch': iteration})
+
+    def add_batch(self, desired, outputs, loss, gradient, forward_s,
+                  gradient_s, update_s):
+        """
+        Accumulates the metrics of one update; [loss] is the summed abs
+        performance of the batch. Without callbacks nothing reads them,
+        so nothing is done.
+        """
+        if not self.instrumented:
+            return
+        loss = float(loss)
+        correct = int(np.count_nonzero(np.round(outputs) == desired))
+        norm = float(np.sqrt(np.dot(gradient, gradient)))
+        size = np.size(desired)
+        self.samples += size
+        self.loss += loss
+        self.correct += correct
+        self.forward_s += forward_s
+        self.gradient_s += gradient_s
+        self.update_s += update_s
+        self.gradient_norm += norm
+        logs = {'batch': self.batches, 'samples': size, 'loss': loss/size,
+                'accuracy': float(correct)/size, 'forward_s': forward_s,
+                'gradient_s': gradient_s, 'update_s': update_s,
+                'gradient_norm': norm}
+        for callback in self.callbacks:
+            callback.on_batch(self.batches, logs)
+        self.batches += 1
+
+    def validation_performance(self):
+        """Mean abs performance on the held-out data."""
+        return mean_abs_performance(self.network, self.validation)
+
+    def end_iteration(self, iteration, abs_mean_performance):
+        """
+        Scores the finished iteration, reports it to the callbacks and
+        updates the rate. Returns True when training should stop early.
+        """
+        epoch_s = time.perf_counter() - self.epoch_start
+        metric = abs_mean_performance
+        stop = False
+        logs = {'epoch': iteration,
+                'samples': self.samples,
+                'loss': float(abs_mean_performance),
+                'accuracy': float(self.correct)/max(self.samples, 1),
+                'forward_s': self.forward_s,
+                'gradient_s': self.gradient_s,
+                'update_s': self.update_s,
+                'epoch_s': epoch_s,
+                'samples_per_s': self.samples/epoch_s if epoch_s else 0.0,
+                'gradient_norm': self.gradient_norm/max(self.batches, 1),
+                'rate': self.optimizer.rate}
+        if self.validation is not None:
+            metric = self.validation_performance()
+            logs['validation_performance'] = metric
+            if self.best is None or metric < self.best:
+                self.best = metric
+                self.best_parameters = self.network.get_parameters().copy()
+                self.wait = 0
+            else:
+                self.wait += 1
+                if self.patience is not None and self.wait >= self.patience:
+                    if self.verbose:
+                        print("iter %d: stopping early, validation performance "
+                              "%1.6f has not improved for %d iterations"
+                              %(iteration, self.best, self.wait))
+                    stop = True
+        self.logs = logs
+        for callback in self.callbacks:
+            callback.on_epoch_end(iteration, logs)
+        if self.schedule is not None:
+            self.optimizer.rate = self.schedule(iteration + 1, self.base_rate, metric)
+        return stop
+
+    def finish(self):
+        """Restores the best parameters seen, if asked to."""
+        if self.restore_best and self.best_parameters is not None:
+            self.network.set_parameters(self.best_parameters)
+        for callback in self.callbacks:
+            callback.on_train_end(self.logs)
+
+
+def iter_batches(chunks, batch_size, shuffle_buffer=None, rng=None):
+    """
+    Regroups an iterable of (rows, columns) arrays into batches of
+    [batch_size] rows, the last one possibly smaller. With [shuffle_buffer]
+    rows are pooled until at least that many are held, the pool is
+    shuffled and all but half a buffer is emitted, so memory stays
+    bounded by the buffer plus one chunk.
+    """
+    pending = None
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=float)
+        if pending is None or len(pending) == 0:
+            pending = chunk
+        else:
+            pending = np.concatenate([pending, chunk])
+        if shuffle_buffer:
+            if len(pending) < shuffle_buffer:
+                continue
+            pending = pending[rng.permutation(len(pending))]
+            ready = len(pending) - shuffle_buffer//2
+        else:
+            ready = len(pending)
+        ready -= ready % batch_size
+        for start in range(0, ready, batch_size):
+            yield pending[start:start + batch_size]
+        pending = pending[ready:]
+
+    if pending is not None and len(pending):
+        if shuffle_buffer:
+            pending = pending[rng.permutation(len(pending))]
+        for start in range(0, len(pending), batch_size):
+            yield pending[start:start + batch_size]
+
+
+def train_batches(network, data, rate, target_abs_mean_performance,
+                  max_iterations, verbose, batch_size, plot=None,
+                  shuffle_buffer=None, optimizer=None, control=None,
+                  summary=True):
+    """
+    Mini-batch version of train(). Gradients for a whole batch come from
+    one CompiledNetwork.backward() call over a NumPy array of the data.
+    [data] is either an in-memory sequence of rows or, when it has no
+    len(), an iterable of row chunks that is streamed through once per
+    iteration. The trained weights are written back to the network at
+    the end. [control] is the TrainingControl built by train(), and
+    [summary] is train()'s. Returns the plot thread, as train() does.
+    """
+    if optimizer is None:
+        optimizer = SGD(rate)
+    if control is None:
+        control = TrainingControl(network, optimizer)
+    compiled = network.compile()
+    n_inputs = compiled.n_inputs
+    streaming = not hasattr(data, '__len__')
+    if streaming:
+        chunks = data
+    else:
+        chunks = [np.asarray(data, dtype=float)]
+    batch_size = max(1, int(batch_size))
+    rng = np.random.default_rng(0)
+
+    iteration = 0
+    seen = 0
+    while iteration < max_iterations:
+        abs_performance = 0.0
+        correct = 0
+        seen = 0
+        control.start_iteration(iteration)
+        for batch in iter_batches(chunks, batch_size, shuffle_buffer, rng):
+            start = time.perf_counter()
+            d = batch[:, -1]
+            activations = compiled.activations(batch[:, :n_inputs])
+            forward_done = time.perf_counter()
+            outputs, performance, gradient = \
+                compiled.backward(batch[:, :n_inputs], d, activations)
+            gradient /= len(d)
+            gradient_done = time.perf_counter()
+            correct += np.count_nonzero(np.round(outputs) == d)
+            abs_performance += abs(performance)
+            seen += len(d)
+
+            optimizer.step(compiled.params, gradient)
+            compiled.assemble()
+            control.add_batch(d, outputs, abs(performance), gradient,
+                              forward_done - start,
+                              gradient_done - forward_done,
+                              time.perf_counter() - gradient_done)
+
+        if seen == 0:
+            # a one-shot generator has nothing left for another pass
+            if verbose:
+                print("iter %d: training data exhausted" %(iteration))
+            break
 
-        network.clear_cache()
+        abs_mean_performance = abs_performance/seen
+        stop = control.end_iteration(iteration, abs_mean_performance)
 
-        if prediction == datum[-1]:
-            correct+=1
+        if abs_mean_performance < target_abs_mean_performance:
             if verbose:
-                print("test(%s) returned: %s => %s [%s]" %(str(datum),
-                                                           str(result),
-                                                           datum[-1],
-                                                           "correct"))
+                print("iter %d: training complete.\n"\
+                      "mean-abs-performance threshold %s reached (%1.6f)"\
+                      %(iteration,
+                        target_abs_mean_performance,
+                        abs_mean_performance))
+            break
+
+        iteration += 1
+
+        if iteration % 10 == 0 and verbose:
+            print("iter %d: mean-abs-performance = %1.6f"\
+                  %(iteration,
+                    abs_mean_performance))
+
+        if stop:
+            break
+
+    control.finish()
+    compiled.store_weights()
+    if summary:
+        if isinstance(network, DenseNetwork):
+            print('weights:', network)
         else:
+            print('weights:', network.weights)
+        if seen:
+            print("Train Acc: ", float(correct)/seen)
+    if plot and not streaming:
+        return plot_decision_boundary(network, data, filename=plot,
+                                      background=True)
+
+
+def mean_abs_performance(network, data):
+    """
+    Scores [network] on the (rows, inputs + 1) array [data] in one
+    batched pass and returns the mean abs performance per row.
+    """
+    outputs = network.predict_batch(data[:, :len(network.inputs)])
+    performance, _ = network.performance.evaluate_batch(data[:, -1], outputs)
+    return abs(float(performance))/len(data)
+
+def uniform_weights(rng, n):
+    """Draws [n] initial weights uniformly from [-1, 1) with [rng]."""
+    return rng.uniform(-1, 1, n)
+
+def train_restart(task):
+    """
+    Trains one restart for one round of train_restarts(), possibly in a
+    worker process. [task] holds net_fn, the starting parameters, the
+    training data, the data to score on, rate, iterations, the target
+    performance and batch_size. Returns the trained parameters and
+    their mean abs performance.
+    """
+    (net_fn, parameters, data, score_data, rate, iterations,
+     target_abs_mean_performance, batch_size) = task
+    network = net_fn()
+    network.set_parameters(parameters)
+    train(network, data, rate=rate,
+          target_abs_mean_performance=target_abs_mean_performance,
+          max_iterations=iterations, batch_size=batch_size, summary=False)
+    return network.get_parameters().copy(), \
+        mean_abs_performance(network, score_data)
+
+def train_restarts(net_fn, data, restarts=8, jobs=None, rate=1.0,
+                   target_abs_mean_performance=0.0001, max_iterations=10000,
+                   batch_size=None, validation_data=None, init=uniform_weights,
+                   seed=0, verbose=False):
+    """
+    Trains [restarts] copies of net_fn() from different initial weights
+    on [jobs] processes (all CPUs by default, in this process for 1) and
+    returns the best one as a trained net_fn() network.
+    The first restart keeps net_fn()'s own weights, restart k draws them
+    with init(np.random.default_rng([seed] + k), number of weights).
+    Losers are dropped by successive halving: every round trains the
+    survivors for the same share of [max_iterations], ranks them by mean
+    abs performance on [validation_data] (or [data]) and keeps the
+    better half, so the last one standing has trained [max_iterations]
+    in all. Training stops as soon as one restart scores under
+    [target_abs_mean_performance]. Each round restarts SGD([rate]) from
+    the passed-on parameters.
+    """
+    data = np.asarray(data, dtype=float)
+    score_data = data if validation_data is None \
+        else np.asarray(validation_data, dtype=float)
+    network = net_fn()
+    candidates = [network.get_parameters().copy()]
+    for k in range(1, restarts):
+        rng = np.random.default_rng(seed + k)
+        candidates.append(np.asarray(init(rng, len(candidates[0])), dtype=float))
+    rounds = 1
+    while 2**(rounds - 1) < restarts:
+        rounds += 1
+    iterations = max(1, max_iterations//rounds)
+
+    pool = None
+    if jobs != 1 and restarts > 1:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        for r in range(rounds):
+            tasks = [(net_fn, parameters, data, score_data, rate, iterations,
+                      target_abs_mean_performance, batch_size)
+                     for parameters in candidates]
+            if pool is None:
+                results = list(map(train_restart, tasks))
+            else:
+                results = list(pool.map(train_restart, tasks))
+            ranked = sorted(results, key=lambda result: result[1])
+            best = ranked[0]
             if verbose:
-                print("test(%s) returned: %s => %s [%s]" %(str(datum),
-                                                           str(result),
-                                                           datum[-1],
-                                                           "wrong"))
+                print("round %d: %d restarts, best mean-abs-performance = %1.6f"
+                      %(r, len(results), best[1]))
+            if best[1] < target_abs_mean_performance:
+                break
+            candidates = [result[0] for result in ranked[:(len(ranked) + 1)//2]]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    network.set_parameters(best[0])
+    return network
+
+
+def test(network, data, verbose=False):
+    """Test the neural net on some given data."""
+    dataset = np.asarray(data, dtype=float)
+    results = network.predict_batch(dataset[:, :len(network.inputs)])
+    predictions = np.round(results)
+    correct = np.count_nonzero(predictions == dataset[:, -1])
+
+    if verbose:
+        for datum, result, prediction in zip(data, results, predictions):
+            print("test(%s) returned: %s => %s [%s]" %(str(datum),
+                                                       str(result),
+                                                       datum[-1],
+                                                       "correct" if prediction == datum[-1]
+                                                       else "wrong"))
 
     return float(correct)/len(data)
 
@@ -611,64 +2206,112 @@ def test(network, data, verbose=False):
 
 
 
-def plot_decision_boundary(network,data, xmin=-10, xmax=10, ymin=-10, ymax=10):
-    
-    if(input("Do you want to plot ? y/n \n") == 'y'):    
-        print("Ploting on duty ...")
-        X = np.array([[item[0], item[1]] for item in data])
-        y = np.array([item[2] for item in data])
-        x_min =  X[:, 0].min() - 10*0.02
-        x_max = X[:, 0].max() + 10*0.02
-        y_min = X[:, 1].min() - 10*0.02
-        y_max = X[:, 1].max() + 10*0.02
-        xx, yy = np.meshgrid(np.arange(x_min, x_max, 0.02),np.arange(y_min, y_max, 0.02))
-        temp = np.c_[xx.ravel(), yy.ravel()]
-        newdata = []
-        for i in range(len(temp)):
-            newdata.append((temp[i, 0], temp[i, 1]))
-        z = []
-        inputSize = len(network.inputs)
-        for elem in newdata:
-            for i in range(inputSize):
-                network.inputs[i].set_value(elem[i])
-            network.clear_cache()
-            result = network.output.output()
-            prediction = round(result)
-            network.clear_cache()
-            z.append(prediction)
-        z = np.array(z)
-        z = z.reshape(xx.shape)
+def plot_decision_boundary(network,data, xmin=-10, xmax=10, ymin=-10, ymax=10,
+                           filename="Graph.png", show=False, background=False):
+    """
+    Saves the decision boundary of [network] around [data] to [filename].
+    Rendering uses the file-only Agg canvas, so nothing waits on a display
+    or on stdin. With [background] the image is drawn on a separate thread,
+    which is returned so callers can join() it. [show] additionally opens
+    the figure in an interactive pyplot window.
+    """
+    X = np.array([[item[0], item[1]] for item in data])
+    y = np.array([item[2] for item in data])
+    x_min =  X[:, 0].min() - 10*0.02
+    x_max = X[:, 0].max() + 10*0.02
+    y_min = X[:, 1].min() - 10*0.02
+    y_max = X[:, 1].max() + 10*0.02
+    xx, yy = np.meshgrid(np.arange(x_min, x_max, 0.02),np.arange(y_min, y_max, 0.02))
+    temp = np.c_[xx.ravel(), yy.ravel()]
+    # predict now so later weight updates don't leak into the picture
+    z = np.round(network.predict_batch(temp))
+    z = z.reshape(xx.shape)
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    def render():
+        fig = Figure(figsize=(6, 6))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        ax.contourf(xx, yy, z,cmap='coolwarm', alpha=1)
+        ax.contour(xx, yy, z, colors='gray', linewidths=0.05)
+        ax.scatter(X[:, 0], X[:, 1], c=y, cmap='binary', edgecolors='black')
+        fig.savefig(filename)
+
+    if show:
+        import matplotlib.pyplot as plt
         plt.figure(figsize=(6, 6))
         plt.contourf(xx, yy, z,cmap='coolwarm', alpha=1)
         plt.contour(xx, yy, z, colors='gray', linewidths=0.05)
-        plt.scatter(X[:, 0], X[:, 1], cmap='binary', edgecolors='black')
-        plt.savefig("Graph.png")
+        plt.scatter(X[:, 0], X[:, 1], c=y, cmap='binary', edgecolors='black')
         plt.show()
 
-        input('press <ENTER> to continue')
+    if background:
+        thread = threading.Thread(target=render)
+        thread.start()
+        return thread
+    render()
+
+
+def gradient_check(network, data=None, epsilon=1e-6, max_elements=10**7):
+    """
+    Compares the backward-pass gradient of the summed performance over
+    [data] with central differences (P(w+e) - P(w-e))/2e, for every
+    weight at once: all 2*len(weights) perturbed parameter vectors are
+    scored in one vectorized forward pass (split only to keep each pass
+    under [max_elements] activations). Without [data] the network's
+    current inputs and desired value are used as a single sample.
+    Returns a dict of arrays ordered like network.weights: 'names',
+    'analytic', 'numeric', 'abs_error' and 'rel_error'.
+    """
+    compiled = network.compile()
+    if data is None:
+        X = np.array([[i.get_value() for i in network.inputs]], dtype=float)
+        desired = np.array([network.performance.my_desired_val], dtype=float)
+    else:
+        dataset = np.asarray(data, dtype=float)
+        X = dataset[:, :compiled.n_inputs]
+        desired = dataset[:, -1]
+
+    _, _, analytic = compiled.backward(X, desired)
+
+    params = compiled.params
+    n = len(params)
+    # each perturbed set holds its activations and a copy of params
+    per_set = max(1, len(X)*compiled.n_columns, n)
+    step = max(1, max_elements//per_set)
+    performances = np.empty(2*n)
+    for start in range(0, 2*n, step):
+        # sets k < n add epsilon to weight k, the rest subtract it from k - n
+        k = np.arange(start, min(start + step, 2*n))
+        param_sets = np.tile(params, (len(k), 1))
+        param_sets[np.arange(len(k)), k % n] += np.where(k < n, epsilon, -epsilon)
+        outputs = compiled.forward_many(param_sets, X)
+        performances[start:start + step], _ = \
+            network.performance.evaluate_batch(desired, outputs)
+        performances[start:start + step] -= \
+            len(X)*network.performance.penalty(param_sets)
+    numeric = (performances[:n] - performances[n:])/(2*epsilon)
+
+    abs_error = np.abs(analytic - numeric)
+    scale = np.maximum(np.abs(analytic) + np.abs(numeric), 1e-12)
+    return {'names': network.parameter_names(),
+            'analytic': analytic,
+            'numeric': numeric,
+            'abs_error': abs_error,
+            'rel_error': abs_error/scale}
 
 
 def finite_difference(network):
-    weights = list()
-    PerfElement = list()
-    weights = network.weights
-    PerfElement = network.performance
-
-    for weight in weights:
-        network.clear_cache()
-
-        preWeight = weight.get_value()
-        NewWeight = (weight.get_value() + 1e-8)
-        oldPerf = PerfElement.output()
-        dev = PerfElement.dOutdx(weight)
-        weight.set_value(weight.get_value() + (1e-8))
-        network.clear_cache()
-        newPer = (network.performance).output()
-        weight.set_value(preWeight)
-        finite_diff = (newPer - oldPerf) / (1e-8)
-        if abs(network.performance.dOutdX(weight) - finite_diff) < 1e-4:
+    """
+    Prints, for each weight, whether the backward-pass gradient at the
+    network's current inputs matches a finite difference to within 1e-4.
+    """
+    check = gradient_check(network)
+    for error in check['abs_error']:
+        if error < 1e-4:
             print("True")
         else:
             print("False")
-
-    network.clear_cache()
\ No newline at end of file
+    return check
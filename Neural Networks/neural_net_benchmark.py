@@ -0,0 +1,154 @@
+#
+# Timing benchmarks for the network builders and data sets used in
+# neural_net_tester.py. Results are printed (or written) as JSON so runs
+# from different commits can be compared.
+#
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+
+from neural_net import train, test,\
+     make_neural_net_basic,\
+     make_neural_net_two_layer,\
+     make_neural_net_challenging,\
+     make_neural_net_two_moons
+
+from neural_net_data import all_data_sets, two_moons_data_set
+
+builders = [make_neural_net_basic,
+            make_neural_net_two_layer,
+            make_neural_net_challenging,
+            make_neural_net_two_moons]
+
+def scale_data_set(data, factor, noise=0.05, seed=0):
+    """Repeats [data] [factor] times, jittering the inputs with gaussian
+    [noise] so the copies are not identical."""
+    data = np.asarray(data, dtype=float)
+    rows = np.tile(data, (factor, 1))
+    rng = np.random.default_rng(seed)
+    rows[:, :-1] += rng.normal(0, noise, size=rows[:, :-1].shape)
+    return rows
+
+def best_time(fn, repeat=3):
+    """Returns the fastest of [repeat] runs of fn(), in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def forward_each(net, rows):
+    """Evaluates [rows] one at a time through the Neuron object graph."""
+    for row in rows:
+        for i in range(len(net.inputs)):
+            net.inputs[i].set_value(row[i])
+        net.clear_cache()
+        net.output.output()
+
+def gradient_each(net, rows, recursive=False):
+    """Asks the performance element for every dP/dw, one datum at a time."""
+    performance = net.performance
+    for row in rows:
+        for i in range(len(net.inputs)):
+            net.inputs[i].set_value(row[i])
+        performance.set_desired(row[-1])
+        net.clear_cache()
+        for w in net.weights:
+            if recursive:
+                performance.compute_doutdx(w)
+            else:
+                performance.dOutdX(w)
+
+def benchmark(builder, name, training_data, test_data, repeat=3, sample_limit=200):
+    """Times one builder on one data set and returns a result dict."""
+    training_data = np.asarray(training_data, dtype=float)
+    test_data = np.asarray(test_data, dtype=float)
+    # the object-graph paths are slow, time them on a prefix of the data
+    rows = training_data[:sample_limit]
+
+    construct = best_time(builder, repeat)
+    net = builder()
+    n_weights = len(net.weights)
+    forward = best_time(lambda: forward_each(net, rows), repeat)
+    forward_batch = best_time(
+        lambda: net.predict_batch(training_data[:, :len(net.inputs)]), repeat)
+    gradient = best_time(lambda: gradient_each(net, rows), repeat)
+    gradient_recursive = best_time(
+        lambda: gradient_each(net, rows[:20], recursive=True), 1)
+    epoch = best_time(
+        lambda: train(builder(), rows, max_iterations=1, summary=False), 1)
+    epoch_batch = best_time(
+        lambda: train(builder(), training_data, max_iterations=1,
+                      batch_size=32, summary=False), repeat)
+    testing = best_time(lambda: test(net, test_data), repeat)
+
+    # tracing slows allocation down, so measure memory in a separate pass
+    tracemalloc.start()
+    train(builder(), training_data, max_iterations=1, batch_size=32,
+          summary=False)
+    test(net, test_data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "builder": builder.__name__,
+        "data_set": name,
+        "train_samples": len(training_data),
+        "test_samples": len(test_data),
+        "weights": n_weights,
+        "construct_s": construct,
+        "forward_samples_per_s": len(rows)/forward,
+        "forward_batch_samples_per_s": len(training_data)/forward_batch,
+        "gradient_us": 1e6*gradient/(len(rows)*n_weights),
+        "gradient_recursive_us": 1e6*gradient_recursive/(len(rows[:20])*n_weights),
+        "train_epoch_samples_per_s": len(rows)/epoch,
+        "train_batch_epoch_samples_per_s": len(training_data)/epoch_batch,
+        "test_samples_per_s": len(test_data)/testing,
+        "peak_memory_bytes": peak,
+    }
+
+def main(scales=(10, 100), repeat=3, output=None):
+    data_sets = list(all_data_sets)
+    for name, training_data, test_data in two_moons_data_set:
+        for factor in scales:
+            data_sets.append(("%s-x%d" %(name, factor),
+                              scale_data_set(training_data, factor),
+                              scale_data_set(test_data, factor, seed=1)))
+
+    results = []
+    for builder in builders:
+        for name, training_data, test_data in data_sets:
+            result = benchmark(builder, name, training_data, test_data, repeat)
+            print("%-28s %-24s %8.0f samples/s batched forward"
+                  %(builder.__name__, name, result["forward_batch_samples_per_s"]),
+                  file=sys.stderr)
+            results.append(result)
+
+    report = json.dumps({
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=int, nargs="*", default=[10, 100],
+                        help="sizes of the synthetic two-moons copies")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per measurement, the fastest is kept")
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args()
+    main(args.scales, args.repeat, args.output)
@@ -1,7 +1,9 @@
 #
 # Training and Test Data used in neural_net_tester.py
 #
-import pandas as pd
+import os
+import re
+import numpy as np
 """
 1++
 0-+
@@ -282,36 +284,148 @@ letter_l_data = ((0,0,0),
 
 letter_l_test_data = letter_l_data
 
-def load_csv(filename):
-  df = pd.read_csv(filename)
-  data = []
-  for _, row in df.iterrows():
-    row = row.tolist()
-    data.append(row)
+def load_csv(filename, cache=True):
+  """
+  Loads a numeric CSV with a header row as one contiguous float64
+  array of shape (rows, features + 1), the label in the last column.
+  The parsed array is kept in __npycache__/ next to the CSV, keyed by
+  the file's size and mtime, and memory-mapped copy-on-write until the
+  CSV changes, so the result is writable without touching the cache.
+  """
+  stat = os.stat(filename)
+  name = os.path.basename(filename)
+  cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                           '__npycache__')
+  cache_file = os.path.join(cache_dir, '%s.%d-%d.npy'
+                            %(name, stat.st_size, stat.st_mtime_ns))
+  if cache and os.path.exists(cache_file):
+    return np.load(cache_file, mmap_mode='c')
+
+  import pandas as pd
+  data = np.ascontiguousarray(pd.read_csv(filename).to_numpy(dtype=np.float64))
+
+  if cache:
+    try:
+      os.makedirs(cache_dir, exist_ok=True)
+      # only this CSV's entries, not those of e.g. <name>.gz
+      stale = re.compile(re.escape(name) + r'\.\d+-\d+\.npy$')
+      for old in os.listdir(cache_dir):
+        if stale.match(old):
+          os.remove(os.path.join(cache_dir, old))
+      # write then rename so concurrent loaders never see a partial file
+      partial = '%s.%d.tmp' %(cache_file, os.getpid())
+      with open(partial, 'wb') as f:
+        np.save(f, data)
+      os.replace(partial, cache_file)
+      # hand back the same kind of array a cache hit does
+      return np.load(cache_file, mmap_mode='c')
+    except OSError:
+      pass
   return data
 
-two_moons_data = load_csv('two-moons/train.csv')
-two_moons_test_data = load_csv('two-moons/test.csv')
-
-
-simple_data_sets = [("OR", or_data, or_test_data),
-                    ("AND", and_data, and_test_data)
-                    ]
-
-harder_data_sets = [("EQUAL", equal_data, equal_test_data),
-                    ("NOT_EQUAL", neq_data, neq_test_data),
-                    ("horizontal-bands", horiz_band_data, horiz_band_test_data),
-                    ("vertical-bands", vert_band_data, vert_band_test_data),
-                    ("diagonal-band", diag_band_data, diag_band_test_data),
-                    ("inverse-diagonal-band", idiag_band_data,
-                     idiag_band_test_data)
-                    ]
-
-challenging_data_sets = [("moat", moat_data, moat_test_data),
-                         ("letter-l", letter_l_data, letter_l_test_data),
-                         ]
-
-two_moons_data_set = [("two-moons", two_moons_data, two_moons_test_data)]
+class CsvChunks(object):
+  """
+  Streams a numeric CSV with a header row as float64 arrays of up to
+  [chunksize] rows. Every iteration re-reads the file, so it can be
+  passed to train() as a multi-pass data stream.
+  """
+  def __init__(self, filename, chunksize=10000):
+    self.filename = filename
+    self.chunksize = chunksize
+
+  def __iter__(self):
+    import pandas as pd
+    for frame in pd.read_csv(self.filename, chunksize=self.chunksize):
+      yield np.ascontiguousarray(frame.to_numpy(dtype=np.float64))
+
+class ArrayChunks(object):
+  """
+  Streams a (rows, columns) array, e.g. a memory-mapped load_csv
+  result, in chunks of [chunksize] rows without reading it all at once.
+  """
+  def __init__(self, array, chunksize=10000):
+    self.array = array
+    self.chunksize = chunksize
+
+  def __iter__(self):
+    for start in range(0, len(self.array), self.chunksize):
+      yield np.asarray(self.array[start:start + self.chunksize], dtype=np.float64)
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class LazyDataSets(object):
+  """
+  A list of (name, training_data, test_data) entries that is only built
+  the first time it is iterated, indexed or measured. Each source is
+  either a list of entries or a function returning one; adding two
+  LazyDataSets (or a LazyDataSets and a list) stays lazy.
+  """
+  def __init__(self, *sources):
+    self.sources = sources
+    self.data_sets = None
+
+  def resolve(self):
+    if self.data_sets is None:
+      data_sets = []
+      for source in self.sources:
+        if callable(source):
+          source = source()
+        data_sets.extend(source)
+      self.data_sets = data_sets
+    return self.data_sets
+
+  def __iter__(self):
+    return iter(self.resolve())
+
+  def __len__(self):
+    return len(self.resolve())
+
+  def __getitem__(self, index):
+    return self.resolve()[index]
+
+  def __add__(self, other):
+    return LazyDataSets(self, other)
+
+  def __radd__(self, other):
+    return LazyDataSets(other, self)
+
+  def __repr__(self):
+    if self.data_sets is None:
+      return "LazyDataSets(<not loaded>)"
+    return "LazyDataSets(%s)" %([name for name, _, _ in self.data_sets])
+
+def load_two_moons_data_sets():
+  return [("two-moons",
+           load_csv(os.path.join(DATA_DIR, 'two-moons', 'train.csv')),
+           load_csv(os.path.join(DATA_DIR, 'two-moons', 'test.csv')))]
+
+
+simple_data_sets = LazyDataSets([("OR", or_data, or_test_data),
+                                 ("AND", and_data, and_test_data)
+                                 ])
+
+harder_data_sets = LazyDataSets([("EQUAL", equal_data, equal_test_data),
+                                 ("NOT_EQUAL", neq_data, neq_test_data),
+                                 ("horizontal-bands", horiz_band_data, horiz_band_test_data),
+                                 ("vertical-bands", vert_band_data, vert_band_test_data),
+                                 ("diagonal-band", diag_band_data, diag_band_test_data),
+                                 ("inverse-diagonal-band", idiag_band_data,
+                                  idiag_band_test_data)
+                                 ])
+
+challenging_data_sets = LazyDataSets([("moat", moat_data, moat_test_data),
+                                      ("letter-l", letter_l_data, letter_l_test_data),
+                                      ])
+
+two_moons_data_set = LazyDataSets(load_two_moons_data_sets)
 
 all_data_sets = simple_data_sets + harder_data_sets + challenging_data_sets + \
                 two_moons_data_set
+
+def __getattr__(name):
+  # two_moons_data and two_moons_test_data load on first access
+  if name == 'two_moons_data':
+    return two_moons_data_set[0][1]
+  if name == 'two_moons_test_data':
+    return two_moons_data_set[0][2]
+  raise AttributeError("module %r has no attribute %r" %(__name__, name))
@@ -0,0 +1,196 @@
+#
+# Batch prediction for networks saved with Network.save() (or
+# neural_net_tester.py --save). Points are read from stdin, a CSV file or
+# a local TCP socket, scored in vectorized batches through the compiled
+# forward pass and streamed back one "output,class" line per point.
+# A latency and throughput summary goes to stderr.
+#
+import os
+import sys
+import time
+import argparse
+import threading
+import socketserver
+import numpy as np
+
+from neural_net import load_network
+from neural_net_data import CsvChunks
+
+class LatencyReport(object):
+    """
+    Collects the time taken by each batch and summarizes it. Batches are
+    also added to the [parent] report, if any.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.points = 0
+        self.start = time.perf_counter()
+
+    def add(self, seconds, points):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.points += points
+        if self.parent is not None:
+            self.parent.add(seconds, points)
+
+    def summary(self):
+        """Returns the report as a dict, latencies in milliseconds."""
+        with self.lock:
+            latencies = np.array(self.latencies)*1e3
+            points = self.points
+        elapsed = time.perf_counter() - self.start
+        summary = {'batches': len(latencies),
+                   'points': points,
+                   'elapsed_s': elapsed,
+                   'points_per_s': points/elapsed if elapsed else 0.0}
+        if len(latencies):
+            summary['latency_p50_ms'] = float(np.percentile(latencies, 50))
+            summary['latency_p95_ms'] = float(np.percentile(latencies, 95))
+            summary['latency_p99_ms'] = float(np.percentile(latencies, 99))
+            summary['latency_max_ms'] = float(latencies.max())
+        return summary
+
+    def report(self, label="served"):
+        summary = self.summary()
+        line = "%s %d points in %d batches, %.3fs: %.0f points/s" \
+               %(label, summary['points'], summary['batches'],
+                 summary['elapsed_s'], summary['points_per_s'])
+        if summary['batches']:
+            line += ", batch latency p50 %.3fms p95 %.3fms p99 %.3fms max %.3fms" \
+                    %(summary['latency_p50_ms'], summary['latency_p95_ms'],
+                      summary['latency_p99_ms'], summary['latency_max_ms'])
+        print(line, file=sys.stderr)
+
+def parse_points(lines, n_inputs):
+    """
+    Parses lines of comma or whitespace separated numbers into an
+    (N, n_inputs) array. Values past the first [n_inputs] (a label, say)
+    are ignored. Lines that do not parse become NaN rows, so every line
+    still gets an answer and the output stays aligned with the input.
+    """
+    X = np.full((len(lines), n_inputs), np.nan)
+    for k in range(len(lines)):
+        values = lines[k].replace(b',', b' ').split()
+        if len(values) < n_inputs:
+            continue
+        try:
+            X[k] = [float(v) for v in values[:n_inputs]]
+        except ValueError:
+            pass
+    return X
+
+def format_predictions(outputs):
+    """Returns one "output,class" line per network output (NaN for both
+    when the point did not parse)."""
+    classes = np.round(outputs)
+    return "".join(["%.6f,%.0f\n" %(y, c)
+                    for y, c in zip(outputs.tolist(), classes.tolist())]).encode()
+
+def read_batches(read, batch_size):
+    """
+    Yields lists of up to [batch_size] complete lines from [read], a
+    function returning the next bytes (b'' at the end). A batch is
+    handed out as soon as the bytes read so far run out of complete
+    lines, so a client sending one point at a time is answered right
+    away while a busy stream gets full batches. Blank lines are skipped.
+    """
+    pending = b''
+    while True:
+        data = read()
+        if not data:
+            break
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        lines = [line for line in lines if line.strip()]
+        for start in range(0, len(lines), batch_size):
+            yield lines[start:start + batch_size]
+    if pending.strip():
+        yield [pending]
+
+def serve_lines(forward, n_inputs, batches, write, report):
+    """Scores each batch of text lines and writes out its predictions."""
+    for lines in batches:
+        start = time.perf_counter()
+        outputs = forward(parse_points(lines, n_inputs))
+        write(format_predictions(outputs))
+        report.add(time.perf_counter() - start, len(lines))
+
+def serve_csv(forward, n_inputs, filename, batch_size, write, report):
+    """Scores a CSV with a header row, [batch_size] rows at a time."""
+    for chunk in CsvChunks(filename, chunksize=batch_size):
+        start = time.perf_counter()
+        outputs = forward(chunk[:, :n_inputs])
+        write(format_predictions(outputs))
+        report.add(time.perf_counter() - start, len(chunk))
+
+def serve_socket(forward, n_inputs, host, port, batch_size, report):
+    """
+    Answers TCP clients on [host]:[port] until interrupted, each on its
+    own thread. A client sends points one per line and receives the
+    predictions in the same order; closing its side ends the session.
+    """
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            session = LatencyReport(report)
+            def read():
+                return self.request.recv(65536)
+            def write(data):
+                self.request.sendall(data)
+            serve_lines(forward, n_inputs, read_batches(read, batch_size),
+                        write, session)
+            session.report("%s:%d served" %self.client_address)
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer((host, port), Handler) as server:
+        server.daemon_threads = True
+        print("listening on %s:%d" %server.server_address, file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+def main(model, csv=None, port=None, host="127.0.0.1", batch_size=256):
+    network = load_network(model)
+    # compile once: the compiled forward pass only reads the weights, so
+    # socket sessions can share it across threads
+    compiled = network.compile()
+    forward = compiled.forward
+    n_inputs = compiled.n_inputs
+    report = LatencyReport()
+    out = sys.stdout.buffer
+    def write(data):
+        out.write(data)
+        out.flush()
+    try:
+        if port is not None:
+            serve_socket(forward, n_inputs, host, port, batch_size, report)
+        elif csv:
+            serve_csv(forward, n_inputs, csv, batch_size, write, report)
+        else:
+            stdin = sys.stdin.fileno()
+            serve_lines(forward, n_inputs,
+                        read_batches(lambda: os.read(stdin, 65536), batch_size),
+                        write, report)
+    except BrokenPipeError:
+        # the reader went away (piped into head, say); point stdout at
+        # devnull so the final flush does not fail as well
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    report.report()
+    return report.summary()
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="a network saved with save() (.npz)")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--csv", help="score this CSV (with a header row) "
+                        "instead of reading stdin")
+    source.add_argument("--socket", type=int, metavar="PORT",
+                        help="serve clients on this local TCP port")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on with --socket")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="most points scored per forward pass")
+    args = parser.parse_args()
+    main(args.model, args.csv, args.socket, args.host, max(1, args.batch_size))
@@ -1,10 +1,19 @@
+import os
 import sys
+import io
+import argparse
+import functools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 
-from neural_net import train, test,\
+from neural_net import train, test, train_restarts,\
+     plot_decision_boundary,\
      make_neural_net_basic,\
      make_neural_net_two_layer,\
      make_neural_net_challenging,\
-     make_neural_net_two_moons
+     make_neural_net_two_moons,\
+     make_neural_net_two_moons_regularized,\
+     make_neural_net_layers
 
 from neural_net_data import simple_data_sets,\
      harder_data_sets,\
@@ -12,45 +21,142 @@ from neural_net_data import simple_data_sets,\
      two_moons_data_set,\
      all_data_sets
 
-def main(neural_net_func, data_sets, rate=1.0, max_iterations=10000):
-    verbose = True
-    for name, training_data, test_data in data_sets:
-        print("-"*40)
-        print("Training on %s data" %(name))
+def run_data_set(neural_net_func, name, training_data, test_data,
+                 rate, max_iterations, verbose, plot=False, save=None,
+                 restarts=1, jobs=1, tag=None):
+    """Trains a fresh network on one data set and tests it.
+    With [plot] the decision boundary is saved to Graph-<run>.png,
+    with [save] (a directory) the trained network to <save>/<run>.npz,
+    <run> being <tag>-<name>, or just <name> without a [tag].
+    With [restarts] the best of that many randomly restarted networks,
+    trained on [jobs] processes, is kept.
+    Returns the trained (name, value) weights and the test accuracy."""
+    print("-"*40)
+    print("Training on %s data" %(name))
+    run = "%s-%s" %(tag, name) if tag else name
+    if restarts > 1:
+        nn = train_restarts(neural_net_func, training_data, restarts, jobs=jobs,
+                            rate=rate, max_iterations=max_iterations,
+                            verbose=verbose)
+        if plot:
+            plot_decision_boundary(nn, training_data,
+                                   filename="Graph-%s.png" %(run))
+    else:
         nn = neural_net_func()
-        train(nn, training_data, rate=rate, max_iterations=max_iterations,
-              verbose=verbose)
-        print("Trained weights:")
-        for w in nn.weights:
-            print("Weight '%s': %f"%(w.get_name(),w.get_value()))
-        print("Testing on %s test-data" %(name))
-        result = test(nn, test_data, verbose=verbose)
-        print("Accuracy: %f"%(result))
+        plotting = train(nn, training_data, rate=rate,
+                         max_iterations=max_iterations, verbose=verbose,
+                         plot="Graph-%s.png" %(run) if plot else None)
+        if plotting is not None:
+            # finish the picture before the next run starts its own
+            plotting.join()
+    weights = list(zip(nn.parameter_names(), nn.get_parameters()))
+    print("Trained weights:")
+    for w_name, value in weights:
+        print("Weight '%s': %f"%(w_name,value))
+    print("Testing on %s test-data" %(name))
+    result = test(nn, test_data, verbose=verbose)
+    print("Accuracy: %f"%(result))
+    if save:
+        path = os.path.join(save, "%s.npz" %(run))
+        nn.save(path)
+        print("Saved to %s" %(path))
+    return weights, result
+
+def run_data_set_quietly(args):
+    """Runs run_data_set in a worker process and returns its printed
+    log along with its results."""
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        weights, result = run_data_set(*args)
+    return log.getvalue(), weights, result
+
+def main(neural_net_func, data_sets, rate=1.0, max_iterations=10000, jobs=1,
+         plot=False, save=None, restarts=1, tag=None):
+    """
+    Trains and tests [neural_net_func] networks on each of [data_sets].
+    [tag] (the test name) prefixes the names of plotted and saved files,
+    so runs of different tests on the same data set do not collide.
+    """
+    verbose = True
+    if jobs <= 1 or restarts > 1:
+        # with restarts the processes go to the restarts of each data set
+        return [run_data_set(neural_net_func, name, training_data, test_data,
+                             rate, max_iterations, verbose, plot, save,
+                             restarts, jobs, tag)
+                for name, training_data, test_data in data_sets]
+
+    # every data set trains independently, so farm them out and
+    # report the logs and results back in data set order
+    tasks = [(neural_net_func, name, training_data, test_data,
+              rate, max_iterations, verbose, plot, save, 1, 1, tag)
+             for name, training_data, test_data in data_sets]
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for log, weights, result in pool.map(run_data_set_quietly, tasks):
+            sys.stdout.write(log)
+            results.append((weights, result))
+    return results
 
 if __name__=="__main__":
-    test_names = ["simple"]
-    if len(sys.argv) > 1:
-        test_names = sys.argv[1:]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("test_names", nargs="*", default=["simple"])
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="train the data sets on this many processes")
+    parser.add_argument("--plot", action="store_true",
+                        help="save each decision boundary to Graph-<name>.png")
+    parser.add_argument("--hidden", type=int, nargs="*", default=[40],
+                        help="hidden layer sizes tried by two_moons_layers")
+    parser.add_argument("--save", metavar="DIR",
+                        help="save each trained network to DIR/<name>.npz")
+    parser.add_argument("--restarts", type=int, default=1,
+                        help="keep the best of this many randomly initialized "
+                        "networks, trained on --jobs processes")
+    args = parser.parse_args()
+    jobs = args.jobs
+    plot = args.plot
+    save = args.save
+    restarts = args.restarts
+    if save:
+        os.makedirs(save, exist_ok=True)
 
-    for test_name in test_names:
+    for test_name in args.test_names:
         if test_name == "simple":
             # these test simple logical configurations
             main(make_neural_net_basic,
-                 simple_data_sets)
+                 simple_data_sets, jobs=jobs, plot=plot, save=save,
+                 restarts=restarts, tag=test_name)
 
         elif test_name == "two_layer":
             # these test cases are slightly harder
             main(make_neural_net_two_layer,
-                 simple_data_sets + harder_data_sets)
+                 simple_data_sets + harder_data_sets, jobs=jobs, plot=plot,
+                 save=save, restarts=restarts, tag=test_name)
 
         elif test_name == "challenging":
             # these tests require a more complex architecture.
-            main(make_neural_net_challenging, challenging_data_sets)
+            main(make_neural_net_challenging, challenging_data_sets, jobs=jobs, plot=plot,
+                 save=save, restarts=restarts, tag=test_name)
 
         elif test_name == "two_moons":
             # this dataset illustrates the overfitting problem
-            main(make_neural_net_two_moons, two_moons_data_set, max_iterations=1000)
+            main(make_neural_net_two_moons, two_moons_data_set, max_iterations=1000,
+                 jobs=jobs, plot=plot, save=save,
+                 restarts=restarts, tag=test_name)
+
+        elif test_name == "two_moons_regularized":
+            # the same, with an L2 weight penalty to curb the overfitting
+            main(make_neural_net_two_moons_regularized, two_moons_data_set,
+                 max_iterations=1000, jobs=jobs, plot=plot, save=save,
+                 restarts=restarts, tag=test_name)
+
+        elif test_name == "two_moons_layers":
+            # the two-moons network built from a layer spec, one run per
+            # hidden layer size
+            for hidden in args.hidden:
+                main(functools.partial(make_neural_net_layers, [2, hidden, 1]),
+                     two_moons_data_set, max_iterations=1000, jobs=jobs, plot=plot,
+                     save=save, restarts=restarts,
+                     tag="%s-%d" %(test_name, hidden))
 
         else:
             print("unrecognized test name %s" %(test_name))
-            
\ No newline at end of file
@@ -3,7 +3,9 @@ import numpy as np
 def alphabetize(x,y):
     if x.get_name()>y.get_name():
         return 1
-    return -1
+    if x.get_name()<y.get_name():
+        return -1
+    return 0
 
 def abs_mean(values):
     """Compute the mean of the absolute values a set of numbers.